@@ -0,0 +1,6 @@
+"""
+Helpers shared by the scripts in the lab directories
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Streaming compression for uploads
+
+Before a file is uploaded its first SAMPLE_SIZE bytes are compressed as a
+quick test. If they shrink to less than MAX_RATIO of their size the whole
+file is compressed as it's streamed, with zstd if the zstandard package is
+installed and zlib otherwise, and the codec is stored in the object's
+metadata under CODEC_METADATA so downloads know how to undo it. Files that
+don't compress, like media or archives, are sent as they are.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_METADATA = "Codec"
+SAMPLE_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+MAX_RATIO = 0.9
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def choose_codec(sample):
+    """Returns the codec to compress data starting with sample with, or None
+    if it isn't worth compressing
+    """
+    if not sample:
+        return None
+    if len(zlib.compress(sample, 1)) > MAX_RATIO * len(sample):
+        return None
+    return "zstd" if zstandard is not None else "zlib"
+
+
+def file_codec(path):
+    with open(path, "rb") as infile:
+        return choose_codec(infile.read(SAMPLE_SIZE))
+
+
+def compressor(codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    if codec == "zlib":
+        return zlib.compressobj(ZLIB_LEVEL)
+    raise ValueError(f"unknown codec {codec}")
+
+
+def decompressor(codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise ValueError("the zstandard package is needed to decompress")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == "zlib":
+        return zlib.decompressobj()
+    raise ValueError(f"unknown codec {codec}")
+
+
+def compress_chunks(chunks, codec):
+    """Yields the compressed form of the concatenated chunks"""
+    comp = compressor(codec)
+    for chunk in chunks:
+        data = comp.compress(chunk)
+        if data:
+            yield data
+    yield comp.flush()
+
+
+def decompress_chunks(chunks, codec):
+    decomp = decompressor(codec)
+    for chunk in chunks:
+        data = decomp.decompress(chunk)
+        if data:
+            yield data
+    yield decomp.flush()
+
+
+def read_file(path, read_size=READ_SIZE):
+    with open(path, "rb") as infile:
+        yield from iter(lambda: infile.read(read_size), b"")
+
+
+def compress_file(path, codec):
+    """Yields the contents of path compressed with codec, or as they are if
+    codec is None
+    """
+    if codec is None:
+        return read_file(path)
+    return compress_chunks(read_file(path), codec)
+
+
+class DecompressingWriter:
+    """Wraps a writable file, decompressing everything written to it.
+    close must be called to write out the end of the stream but doesn't
+    close the wrapped file
+    """
+
+    def __init__(self, outfile, codec):
+        self.outfile = outfile
+        self._decomp = decompressor(codec)
+
+    def write(self, data):
+        self.outfile.write(self._decomp.decompress(data))
+        return len(data)
+
+    def close(self):
+        self.outfile.write(self._decomp.flush())
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Launches fleets of EC2 instances and waits for them together
+
+Instances are tagged by RunInstances itself through TagSpecifications
+rather than with a create_tags call each once they're up, and a single
+poller follows every instance in the fleet with batched describe_instances
+calls instead of one waiter per instance. The poller backs off while
+nothing is changing and speeds up again as instances come up, yielding
+each one as soon as it reaches a final state, so a fleet of any size is up
+in roughly the time it takes one instance to boot.
+
+Fleets are stopped and terminated the same way, in chunks of CHANGE_LIMIT
+instances sent concurrently, each chunk followed by one poller. Throttled
+calls are retried with backoff, and each instance gets a LifecycleResult,
+so one instance that can't be stopped doesn't hide what happened to the
+rest.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import random
+import time
+from botocore.exceptions import ClientError
+
+# Most values describe_instances takes in one filter
+DESCRIBE_LIMIT = 200
+MIN_POLL = 1.0
+MAX_POLL = 15.0
+POLL_BACKOFF = 1.5
+FLEET_TIMEOUT = 600
+# States an instance can't get to the target state from
+DEAD_ENDS = {
+    "running": {"shutting-down", "terminated", "stopping", "stopped"},
+    "stopped": {"shutting-down", "terminated"},
+}
+# Instances stopped or terminated per call, and calls made at once
+CHANGE_LIMIT = 100
+CHANGE_WORKERS = 8
+THROTTLE_CODES = {"RequestLimitExceeded", "Throttling"}
+MAX_RETRIES = 6
+RETRY_BASE = 0.5
+# Response key listing the instances each state change applied to
+CHANGES = {
+    "stop_instances": ("StoppingInstances", "stopped"),
+    "terminate_instances": ("TerminatingInstances", "terminated"),
+}
+
+LifecycleResult = namedtuple(
+    "LifecycleResult", ["id", "previous_state", "state", "error"]
+)
+
+
+def is_throttled(e):
+    return (
+        isinstance(e, ClientError)
+        and e.response["Error"]["Code"] in THROTTLE_CODES
+    )
+
+
+def with_retries(func, **kwargs):
+    """Calls func with kwargs, retrying with jittered exponential backoff
+    while EC2 is throttling requests
+    """
+    for attempt in range(MAX_RETRIES):
+        try:
+            return func(**kwargs)
+        except ClientError as e:
+            if not is_throttled(e) or attempt == MAX_RETRIES - 1:
+                raise
+            time.sleep(RETRY_BASE * 2 ** attempt * (1 + random.random()))
+
+
+def tag_specifications(tags, resource_types=("instance",)):
+    """Returns TagSpecifications applying the dict tags to each resource
+    type RunInstances creates
+    """
+    tag_list = [{"Key": key, "Value": value} for key, value in tags.items()]
+    return [
+        {"ResourceType": resource_type, "Tags": tag_list}
+        for resource_type in resource_types
+    ]
+
+
+def tag_value(instance, key, default=None):
+    """Returns the value of the tag key from a describe_instances record"""
+    for tag in instance.get("Tags", []):
+        if tag["Key"] == key:
+            return tag["Value"]
+    return default
+
+
+def launch_fleet(ec2_client, count, tags, **run_args):
+    """Launches up to count instances tagged with the dict tags, passing
+    run_args (ImageId, InstanceType...) to RunInstances, and returns their
+    ids
+    """
+    resp = ec2_client.run_instances(
+        MinCount=1,
+        MaxCount=count,
+        TagSpecifications=tag_specifications(tags),
+        **run_args
+    )
+    return [instance["InstanceId"] for instance in resp["Instances"]]
+
+
+def describe(ec2_client, instance_ids):
+    """Yields the describe_instances record of every instance in
+    instance_ids, DESCRIBE_LIMIT ids at a time. The ids are given as a
+    filter rather than as InstanceIds, so ids EC2 doesn't know about yet,
+    as is usual just after a launch, are left out instead of failing the
+    whole call
+    """
+    instance_ids = list(instance_ids)
+    for start in range(0, len(instance_ids), DESCRIBE_LIMIT):
+        pages = ec2_client.get_paginator("describe_instances").paginate(
+            Filters=[{
+                "Name": "instance-id",
+                "Values": instance_ids[start:start + DESCRIBE_LIMIT]
+            }]
+        )
+        for page in pages:
+            for reservation in page["Reservations"]:
+                yield from reservation["Instances"]
+
+
+def wait_for_fleet(ec2_client, instance_ids, state="running",
+                   timeout=FLEET_TIMEOUT):
+    """Yields the describe_instances record of each instance as it reaches
+    state, or a state it can't get to state from, in the order they get
+    there. Raises TimeoutError if any are still pending after timeout
+    seconds
+    """
+    pending = set(instance_ids)
+    dead_ends = DEAD_ENDS.get(state, set())
+    deadline = time.monotonic() + timeout
+    delay = MIN_POLL
+    while pending:
+        progressed = False
+        try:
+            for instance in describe(ec2_client, pending):
+                current = instance["State"]["Name"]
+                if instance["InstanceId"] not in pending:
+                    continue
+                if current == state or current in dead_ends:
+                    pending.discard(instance["InstanceId"])
+                    progressed = True
+                    yield instance
+        except ClientError as e:
+            # Backing off is all there is to do when throttled
+            if not is_throttled(e):
+                raise
+        if not pending:
+            return
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError(
+                f"{len(pending)} instances didn't reach {state}: "
+                f"{', '.join(sorted(pending))}"
+            )
+        # Poll quickly while instances are arriving, back off while none are
+        delay = MIN_POLL if progressed else min(delay * POLL_BACKOFF,
+                                                MAX_POLL)
+        time.sleep(delay)
+
+
+def _change(ec2_client, action, instance_ids):
+    """Applies action to instance_ids, returning {id: LifecycleResult}. If
+    the call is refused, like when one instance is already terminated, the
+    instances are tried one at a time so only the problem ones fail
+    """
+    key = CHANGES[action][0]
+    try:
+        resp = with_retries(
+            getattr(ec2_client, action), InstanceIds=instance_ids
+        )
+    except ClientError as e:
+        if len(instance_ids) == 1 or is_throttled(e):
+            return {
+                instance_id: LifecycleResult(instance_id, None, None, str(e))
+                for instance_id in instance_ids
+            }
+        results = {}
+        for instance_id in instance_ids:
+            results.update(_change(ec2_client, action, [instance_id]))
+        return results
+    return {
+        change["InstanceId"]: LifecycleResult(
+            change["InstanceId"],
+            change["PreviousState"]["Name"],
+            change["CurrentState"]["Name"],
+            None
+        )
+        for change in resp[key]
+    }
+
+
+def _change_chunk(ec2_client, action, instance_ids, wait, timeout):
+    target = CHANGES[action][1]
+    results = _change(ec2_client, action, instance_ids)
+    if not wait:
+        return results
+    pending = [
+        result.id for result in results.values()
+        if result.error is None and result.state != target
+    ]
+    try:
+        for instance in wait_for_fleet(ec2_client, pending, target, timeout):
+            state = instance["State"]["Name"]
+            results[instance["InstanceId"]] = results[
+                instance["InstanceId"]
+            ]._replace(
+                state=state,
+                error=None if state == target else f"instance is {state}"
+            )
+    except TimeoutError as e:
+        for instance_id in pending:
+            if results[instance_id].state != target:
+                results[instance_id] = results[instance_id]._replace(
+                    error=str(e)
+                )
+    return results
+
+
+def change_fleet(ec2_client, action, instance_ids, wait=True,
+                 timeout=FLEET_TIMEOUT, workers=CHANGE_WORKERS):
+    """Applies action, stop_instances or terminate_instances, to
+    instance_ids in chunks of CHANGE_LIMIT, up to workers chunks at once,
+    and if wait is set waits for each chunk to finish with one poller.
+    Returns a LifecycleResult for each instance in the order given, with
+    error set if the change was refused or didn't finish in time
+    """
+    instance_ids = list(dict.fromkeys(instance_ids))
+    chunks = [
+        instance_ids[start:start + CHANGE_LIMIT]
+        for start in range(0, len(instance_ids), CHANGE_LIMIT)
+    ]
+    results = {}
+    if chunks:
+        with ThreadPoolExecutor(
+            max_workers=min(workers, len(chunks))
+        ) as pool:
+            for chunk_results in pool.map(
+                lambda chunk: _change_chunk(
+                    ec2_client, action, chunk, wait, timeout
+                ),
+                chunks
+            ):
+                results.update(chunk_results)
+    return [
+        results.get(
+            instance_id,
+            LifecycleResult(instance_id, None, None, "not changed")
+        )
+        for instance_id in instance_ids
+    ]
+
+
+def stop_fleet(ec2_client, instance_ids, wait=True, timeout=FLEET_TIMEOUT):
+    return change_fleet(
+        ec2_client, "stop_instances", instance_ids, wait, timeout
+    )
+
+
+def terminate_fleet(ec2_client, instance_ids, wait=True,
+                    timeout=FLEET_TIMEOUT):
+    return change_fleet(
+        ec2_client, "terminate_instances", instance_ids, wait, timeout
+    )
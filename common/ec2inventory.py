@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Cached inventory of EC2 instances
+
+describe_instances is paged through once, up to 1000 instances a page, and
+every instance in every reservation is flattened into a compact
+InstanceRecord. Queries for states, IP addresses and tags are answered from
+that snapshot until it's older than the TTL, so reporting on a thousand
+instances takes a couple of API calls rather than a call or more per
+instance.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from collections import namedtuple
+import threading
+import time
+
+DEFAULT_TTL = 10
+PAGE_SIZE = 1000
+
+InstanceRecord = namedtuple(
+    "InstanceRecord",
+    ["id", "state", "public_ip", "tags", "subnet", "az"]
+)
+
+
+def instance_record(instance):
+    """Flattens a describe_instances record into an InstanceRecord"""
+    return InstanceRecord(
+        instance["InstanceId"],
+        instance["State"]["Name"],
+        instance.get("PublicIpAddress"),
+        {tag["Key"]: tag["Value"] for tag in instance.get("Tags", [])},
+        instance.get("SubnetId"),
+        instance.get("Placement", {}).get("AvailabilityZone")
+    )
+
+
+def record_name(record, default="No name"):
+    return record.tags.get("Name", default)
+
+
+class Inventory:
+    """Snapshot of the instances matching filters, the describe_instances
+    filters applied by EC2, refreshed when it's more than ttl seconds old
+    """
+
+    def __init__(self, ec2_client, filters=(), ttl=DEFAULT_TTL):
+        self.ec2_client = ec2_client
+        self.filters = list(filters)
+        self.ttl = ttl
+        self._records = None
+        self._taken = 0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        pages = self.ec2_client.get_paginator("describe_instances").paginate(
+            Filters=self.filters,
+            PaginationConfig={"PageSize": PAGE_SIZE}
+        )
+        records = [
+            instance_record(instance)
+            for page in pages
+            for reservation in page["Reservations"]
+            for instance in reservation["Instances"]
+        ]
+        with self._lock:
+            self._records = records
+            self._taken = time.monotonic()
+        return records
+
+    def invalidate(self):
+        """Makes the next query fetch a new snapshot, for after instances
+        have been started, stopped or terminated
+        """
+        with self._lock:
+            self._records = None
+
+    def records(self):
+        with self._lock:
+            records = self._records
+            fresh = time.monotonic() - self._taken < self.ttl
+        if records is None or not fresh:
+            records = self.refresh()
+        return records
+
+    def in_state(self, *states):
+        """Returns the records of instances in any of states, or of every
+        instance if none are given
+        """
+        return [
+            record for record in self.records()
+            if not states or record.state in states
+        ]
+
+    def get(self, instance_id):
+        for record in self.records():
+            if record.id == instance_id:
+                return record
+        return None
+
+    def tagged(self, key, value=None):
+        return [
+            record for record in self.records()
+            if key in record.tags
+            and (value is None or record.tags[key] == value)
+        ]
+
+    def public_ips(self, state="running"):
+        """Returns {instance id: public IP} for instances in state that have
+        one
+        """
+        return {
+            record.id: record.public_ip for record in self.in_state(state)
+            if record.public_ip
+        }
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+File hashing shared by the sync and restore scripts
+
+Files are read through a single large reusable buffer, or memory mapped and
+handed to hashlib in one call once they're big enough, which keeps Python
+out of the inner loop. hashlib releases the GIL while it works so hash_files
+can hash many files at once on a plain thread pool.
+
+Running this module directly benchmarks it against the original 4 KiB
+read loop on a generated corpus.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import getopt
+import hashlib
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BUFFER_SIZE = 1024 * 1024
+MMAP_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_WORKERS = os.cpu_count() or 4
+
+
+def md5_hash(fname):
+    hash_md5 = hashlib.md5()
+    with open(fname, "rb") as infile:
+        size = os.fstat(infile.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(
+                infile.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mapped:
+                if hasattr(mapped, "madvise"):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+                hash_md5.update(mapped)
+        else:
+            buf = bytearray(min(BUFFER_SIZE, max(size, 1)))
+            view = memoryview(buf)
+            while True:
+                n_read = infile.readinto(buf)
+                if not n_read:
+                    break
+                hash_md5.update(view[:n_read])
+    return hash_md5.hexdigest()
+
+
+def hash_files(paths, workers=DEFAULT_WORKERS, hash_func=md5_hash):
+    """Yields (path, hash) for each of paths in order, hashing up to workers
+    files at a time. paths may be any iterable, only a few times workers of
+    them are pulled from it ahead of the results. Each item is passed to
+    hash_func as it is, so the items can be scan entries given a hash_func
+    that takes them, like one going through a StatCache
+    """
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(hash_func, path)))
+            if len(pending) >= workers * 4:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+def verified_chunks(chunks, expected, name=""):
+    """Passes chunks through, then raises ValueError if their MD5 isn't
+    expected. Uploading them with upload_stream then abandons the upload
+    before the object is stored, rather than storing bytes that don't match
+    the hash they were uploaded under
+    """
+    hash_md5 = hashlib.md5()
+    for chunk in chunks:
+        hash_md5.update(chunk)
+        yield chunk
+    if hash_md5.hexdigest() != expected:
+        raise ValueError(f"{name or 'contents'} changed while being uploaded")
+
+
+def _legacy_md5_hash(fname):
+    hash_md5 = hashlib.md5()
+    with open(fname, "rb") as infile:
+        for chunk in iter(lambda: infile.read(4096), b""):
+            hash_md5.update(chunk)
+    return hash_md5.hexdigest()
+
+
+def _make_corpus(root, n_files, file_size):
+    paths = []
+    for i in range(n_files):
+        path = os.path.join(root, f"file{i}")
+        with open(path, "wb") as outfile:
+            outfile.write(os.urandom(file_size))
+        paths.append(path)
+    return paths
+
+
+def _time(label, func, total_bytes):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<28}{elapsed:8.3f}s"
+        f"{total_bytes / elapsed / 1024 ** 2:10.1f} MiB/s"
+    )
+    return result
+
+
+def benchmark(n_files, file_size, workers):
+    root = tempfile.mkdtemp()
+    try:
+        paths = _make_corpus(root, n_files, file_size)
+        total = n_files * file_size
+        print(
+            f"Hashing {n_files} files of {file_size} bytes "
+            f"with {workers} workers\n"
+        )
+        legacy = _time(
+            "4 KiB read loop",
+            lambda: [_legacy_md5_hash(path) for path in paths],
+            total
+        )
+        serial = _time(
+            "md5_hash",
+            lambda: [md5_hash(path) for path in paths],
+            total
+        )
+        parallel = _time(
+            "hash_files",
+            lambda: [digest for _, digest in hash_files(paths, workers)],
+            total
+        )
+        assert legacy == serial == parallel
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    opts = getopt.getopt(
+        sys.argv[1:], "n:s:w:", ["files=", "size=", "workers="]
+    )[0]
+    n_files = 200
+    file_size = 4 * 1024 * 1024
+    workers = DEFAULT_WORKERS
+    for opt in opts:
+        if opt[0] == '-n' or opt[0] == '--files':
+            n_files = int(opt[1])
+        elif opt[0] == '-s' or opt[0] == '--size':
+            file_size = int(opt[1])
+        elif opt[0] == '-w' or opt[0] == '--workers':
+            workers = int(opt[1])
+    benchmark(n_files, file_size, workers)
+
+
+if __name__ == "__main__":
+    main()
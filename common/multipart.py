@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Uploads a stream of bytes to S3 without staging it on disk first
+
+The chunks of a generator are gathered into parts and sent with a multipart
+upload, a few parts at a time. At most concurrency parts are in flight plus
+the one being filled, so memory use is bounded by part_size * (concurrency
++ 1) however large the stream is. Streams smaller than one part are sent
+with a single PutObject.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+# S3 requires every part but the last to be at least 5 MiB
+PART_SIZE = 8 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+
+
+def _parts(chunks, part_size):
+    part = bytearray()
+    for chunk in chunks:
+        part += chunk
+        while len(part) >= part_size:
+            yield bytes(part[:part_size])
+            del part[:part_size]
+    if part:
+        yield bytes(part)
+
+
+def upload_stream(s3_client, bucket, key, chunks, extra_args=None,
+                  part_size=PART_SIZE, concurrency=UPLOAD_CONCURRENCY):
+    """Uploads the concatenation of chunks to bucket/key, extra_args are
+    passed to PutObject or CreateMultipartUpload (e.g. Metadata)
+    """
+    extra_args = extra_args or {}
+    parts = _parts(chunks, part_size)
+    first = next(parts, b"")
+    second = next(parts, None)
+    if second is None:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=first, **extra_args)
+        return
+
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=bucket, Key=key, **extra_args
+    )["UploadId"]
+    slots = threading.Semaphore(concurrency)
+
+    def send(number, body):
+        try:
+            resp = s3_client.upload_part(
+                Bucket=bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=number,
+                Body=body
+            )
+            return {"PartNumber": number, "ETag": resp["ETag"]}
+        finally:
+            slots.release()
+
+    head = [first, second]
+    del first, second
+
+    def all_parts():
+        while head:
+            yield head.pop(0)
+        yield from parts
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            futures = []
+            for number, body in enumerate(all_parts(), start=1):
+                slots.acquire()
+                futures.append(pool.submit(send, number, body))
+            completed = [future.result() for future in futures]
+        s3_client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={"Parts": completed}
+        )
+    except BaseException:
+        s3_client.abort_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id
+        )
+        raise
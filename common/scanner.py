@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+"""
+Directory scanner shared by the upload scripts
+
+The tree is walked with os.fwalk, which hands over an open descriptor for
+each directory, so each file is stat'ed relative to its directory rather
+than by its full path, exactly once, with the result handed on rather than
+stat'ed again by whoever hashes it. Entries matching an exclude glob, like
+__pycache__ or the .enc files cs_enc.py leaves behind, are skipped, and
+excluded directories aren't descended into at all. Name globs are checked
+against a whole directory listing at once and only tested name by name in
+the rare directories that have something to exclude, so the cost per file
+is little more than the stat.
+
+Like the os.walk loops it replaces, only files below the subdirectories of
+the root are scanned, not files directly in the root.
+
+Running this module directly benchmarks it against os.walk on a generated
+tree.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from collections import deque
+from fnmatch import translate
+import getopt
+import os
+import re
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+DEFAULT_EXCLUDES = (
+    "__pycache__", "*.pyc", "*.enc", "*.part", ".statcache.sqlite*",
+    ".restore-journal.sqlite*"
+)
+
+
+def _compile(patterns):
+    """Returns a function matching a string against any of patterns, since
+    one regex for all of them is much cheaper than fnmatch per glob
+    """
+    if not patterns:
+        return lambda _: None
+    return re.compile("|".join(translate(p) for p in patterns)).match
+
+
+def _is_glob(pattern):
+    return any(c in pattern for c in "*?[")
+
+
+class PathFilter:
+    """Decides which paths are scanned. A glob containing a / is matched
+    against an entry's path relative to the root and any other glob against
+    its name. Excluded directories exclude everything below them, and if
+    there are any include globs a file has to match one of them too
+    """
+
+    def __init__(self, include=(), exclude=DEFAULT_EXCLUDES):
+        self.include = tuple(include)
+        self.exclude = tuple(exclude)
+        name_excludes = [p for p in self.exclude if "/" not in p]
+        self._skip_name = _compile(name_excludes)
+        self._skip_path = _compile([p for p in self.exclude if "/" in p])
+        self._include_name = _compile(
+            [p for p in self.include if "/" not in p]
+        )
+        self._include_path = _compile([p for p in self.include if "/" in p])
+        self.checks_paths = bool(self.include) or any(
+            "/" in p for p in self.exclude
+        )
+        # Plain names, *suffix and prefix* globs can be looked for in a
+        # newline joined listing with set and substring checks in C
+        self._names = frozenset(p for p in name_excludes if not _is_glob(p))
+        self._needles = []
+        self._quick = True
+        for pattern in name_excludes:
+            if pattern in self._names:
+                continue
+            if pattern.startswith("*") and not _is_glob(pattern[1:]):
+                self._needles.append(f"{pattern[1:]}\n")
+            elif pattern.endswith("*") and not _is_glob(pattern[:-1]):
+                self._needles.append(f"\n{pattern[:-1]}")
+            else:
+                self._quick = False
+
+    def skip_name(self, name):
+        return self._skip_name(name) is not None
+
+    def kept_names(self, names):
+        """Returns names, a directory listing, without the names excluded
+        by a name glob
+        """
+        if not names:
+            return names
+        if self._quick and self._names.isdisjoint(names):
+            joined = "\n" + "\n".join(names) + "\n"
+            if not any(needle in joined for needle in self._needles):
+                return names
+        return [name for name in names if not self.skip_name(name)]
+
+    def excluded(self, path, name):
+        return bool(self.skip_name(name) or self._skip_path(path))
+
+    def wanted(self, path, name):
+        """Returns True if the file at path is to be scanned, assuming its
+        directories weren't excluded
+        """
+        if self.excluded(path, name):
+            return False
+        return not self.include or bool(
+            self._include_name(name) or self._include_path(path)
+        )
+
+    def wanted_path(self, path):
+        """Returns True if path is to be scanned, checking its directories
+        as well
+        """
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            if self.excluded("/".join(parts[:i]), parts[i - 1]):
+                return False
+        return self.wanted(path, parts[-1])
+
+
+def scan(root, path_filter=None, errors=None):
+    """Yields (path, name, stat) for every wanted regular file below the
+    subdirectories of root, with path relative to root. Anything that
+    couldn't be read is skipped and appended to errors as (path, error), so
+    callers can tell a file that's gone from one that wasn't seen
+    """
+    path_filter = path_filter or PathFilter()
+    if errors is None:
+        errors = []
+    checks_paths = path_filter.checks_paths
+    prefix = len(os.path.join(root, ""))
+    file_stat = os.stat
+    is_regular = stat.S_ISREG
+
+    # fwalk only gives the name of a directory it can't open, so the
+    # directories it has still to reach are kept to work out its path. Each
+    # one it reaches or fails to open is the next of those in the deepest
+    # directory with any left
+    walking = []
+
+    def next_dir():
+        while walking and not walking[-1][1]:
+            walking.pop()
+        if not walking:
+            return ""
+        parent, names = walking[-1]
+        name = names.popleft()
+        return f"{parent}/{name}" if parent else name
+
+    def unreadable(e):
+        path = next_dir()
+        print(f"Unable to scan {path}: {e}")
+        errors.append((path, e))
+
+    for dir_path, dirs, files, dir_fd in os.fwalk(root, onerror=unreadable):
+        next_dir()
+        current = dir_path[prefix:]
+        dirs[:] = path_filter.kept_names(dirs)
+        if checks_paths:
+            dirs[:] = [
+                name for name in dirs
+                if not path_filter.excluded(
+                    f"{current}/{name}" if current else name, name
+                )
+            ]
+        walking.append((current, deque(dirs)))
+        if not current:
+            continue
+        for name in path_filter.kept_names(files):
+            path = f"{current}/{name}"
+            if checks_paths and not path_filter.wanted(path, name):
+                continue
+            try:
+                st = file_stat(name, dir_fd=dir_fd)
+            except FileNotFoundError:
+                # Removed while we were scanning
+                continue
+            except OSError as e:
+                print(f"Unable to scan {path}: {e}")
+                errors.append((path, e))
+                continue
+            if is_regular(st.st_mode):
+                yield path, name, st
+
+
+def scan_paths(root, paths, path_filter=None):
+    """Returns (entries, missing) for a list of paths relative to root, the
+    (path, name, stat) of each wanted file that exists and the paths that
+    don't
+    """
+    path_filter = path_filter or PathFilter()
+    entries = []
+    missing = []
+    for path in paths:
+        if not path_filter.wanted_path(path):
+            continue
+        try:
+            st = os.stat(os.path.join(root, path))
+        except FileNotFoundError:
+            missing.append(path)
+            continue
+        if stat.S_ISREG(st.st_mode):
+            entries.append((path, path.rsplit("/", 1)[-1], st))
+    return entries, missing
+
+
+def _make_tree(root, n_files, fanout):
+    """Spreads n_files empty files over fanout top level directories of
+    fanout subdirectories each
+    """
+    per_dir = max(1, -(-n_files // (fanout * fanout)))
+    made = 0
+    for i in range(fanout):
+        for j in range(fanout):
+            if made >= n_files:
+                return
+            dir_path = os.path.join(root, f"dir{i}", f"sub{j}")
+            os.makedirs(dir_path)
+            for k in range(min(per_dir, n_files - made)):
+                open(os.path.join(dir_path, f"file{k}"), "wb").close()
+                made += 1
+
+
+def _legacy_walk(root):
+    paths = []
+    for dir_name, subdir_list, file_list in os.walk(root, topdown=True):
+        if dir_name != root:
+            for fname in file_list:
+                path = f"{dir_name}/{fname}"
+                paths.append((path, os.stat(path)))
+    return paths
+
+
+def _drop_caches():
+    """Empties the page, dentry and inode caches so the next scan has to go
+    to disk, which needs root on Linux
+    """
+    os.sync()
+    try:
+        with open("/proc/sys/vm/drop_caches", "w") as outfile:
+            outfile.write("3\n")
+    except OSError as e:
+        print(f"Unable to drop caches, timing a warm scan: {e}")
+
+
+def _time(label, func, cold=False):
+    if cold:
+        _drop_caches()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28}{elapsed:8.3f}s{len(result) / elapsed:12.0f} files/s")
+    return result
+
+
+def benchmark(n_files, fanout, root=None, cold=False):
+    """Times scanning a tree of n_files files, or the existing tree at root,
+    from a cold cache before each scan if cold is set
+    """
+    made = root is None
+    if made:
+        root = tempfile.mkdtemp()
+        print(f"Creating {n_files} files")
+        _make_tree(root, n_files, fanout)
+    try:
+        print(f"Scanning {root}\n")
+        legacy = _time(
+            "os.walk and os.stat", lambda: _legacy_walk(root), cold
+        )
+        scanned = _time("scan", lambda: list(scan(root)), cold)
+        assert len(legacy) == len(scanned)
+    finally:
+        if made:
+            shutil.rmtree(root)
+
+
+def main():
+    opts = getopt.getopt(
+        sys.argv[1:], "n:f:r:c", ["files=", "fanout=", "root=", "cold"]
+    )[0]
+    n_files = 1000000
+    fanout = 100
+    root = None
+    cold = False
+    for opt in opts:
+        if opt[0] == '-n' or opt[0] == '--files':
+            n_files = int(opt[1])
+        elif opt[0] == '-f' or opt[0] == '--fanout':
+            fanout = int(opt[1])
+        elif opt[0] == '-r' or opt[0] == '--root':
+            root = opt[1]
+        elif opt[0] == '-c' or opt[0] == '--cold':
+            cold = True
+    benchmark(n_files, fanout, root, cold)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Persistent cache of file hashes keyed by stat information
+
+Hashing a file means reading every byte of it, so the sync scripts remember
+the hash of each file along with its size, modification time and inode in a
+small SQLite database next to the root being synced. A file is only hashed
+again when one of those change, or when a rehash is forced.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+import os
+import sqlite3
+import threading
+import time
+from common.hashing import md5_hash
+
+CACHE_NAME = ".statcache.sqlite"
+FLUSH_EVERY = 1000
+FLUSH_INTERVAL = 5
+# Files modified this recently may still be changing within the resolution
+# of their mtime, so their hashes are never cached
+RACY_WINDOW_NS = 2 * 10 ** 9
+
+
+class StatCache:
+    def __init__(self, root, hash_func=md5_hash, name=CACHE_NAME,
+                 rehash=False):
+        self.path = os.path.join(root, name)
+        self.hash_func = hash_func
+        self.rehash = rehash
+        self._pending = {}
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            "ino INTEGER, md5 TEXT)"
+        )
+        self._conn.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup(self, path, st):
+        """Returns the cached hash of path if its stat result is unchanged,
+        otherwise None
+        """
+        with self._lock:
+            row = self._pending.get(path)
+            if row is None:
+                row = self._conn.execute(
+                    "SELECT size, mtime_ns, ino, md5 FROM files WHERE path = ?",
+                    (path,)
+                ).fetchone()
+        if row and tuple(row[:3]) == (st.st_size, st.st_mtime_ns, st.st_ino):
+            return row[3]
+        return None
+
+    def store(self, path, st, md5, verified=False):
+        """Remembers md5 as the hash of path while its stat result matches
+        st. Recently modified files are skipped unless verified says the
+        caller wrote the file itself and knows md5 is right
+        """
+        if not verified and time.time_ns() - st.st_mtime_ns < RACY_WINDOW_NS:
+            return
+        with self._lock:
+            self._pending[path] = (st.st_size, st.st_mtime_ns, st.st_ino, md5)
+            if (len(self._pending) >= FLUSH_EVERY
+                    or time.monotonic() - self._flushed_at >= FLUSH_INTERVAL):
+                self._flush()
+
+    def hash(self, path, st=None):
+        """Returns the hash of path, only reading the file if it has changed
+        since it was last hashed or a rehash was requested
+        """
+        if st is None:
+            st = os.stat(path)
+        if not self.rehash:
+            md5 = self.lookup(path, st)
+            if md5 is not None:
+                return md5
+        md5 = self.hash_func(path)
+        self.store(path, st, md5)
+        return md5
+
+    def _flush(self):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+            [(path, *row) for path, row in self._pending.items()]
+        )
+        self._conn.commit()
+        self._pending.clear()
+        self._flushed_at = time.monotonic()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
@@ -10,97 +10,113 @@ __copyright__ = "Copyright 2020"
 
 
 """
+import os
+import sys
 from time import sleep
 import boto3
 from namesgenerator import get_random_name
 
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from common.ec2fleet import (
+    launch_fleet, stop_fleet, terminate_fleet, wait_for_fleet
+)
+from common.ec2inventory import Inventory, instance_record, record_name
+
 KEY_NAME = "YOUR KEY HERE"
 SG_NAME = "YOUR SECURITY GROUP HERE"
 
-def create_instances(ec2_resource, n_instances):
-    """Creates n EC2 t2.micro instances in a given security group
+def create_instances(ec2_client, n_instances):
+    """Creates n EC2 t2.micro instances in a given security group, printing
+    each one as soon as it's running rather than waiting on them in turn,
+    and returns their InstanceRecords. The whole launch shares one name
+    since it's applied by RunInstances
     """
-    instances = ec2_resource.create_instances(
+    ids = launch_fleet(
+        ec2_client,
+        n_instances,
+        {"Name": get_random_name()},
         ImageId="ami-d38a4ab1",
-        MinCount=1,
-        MaxCount=n_instances,
         InstanceType="t2.micro",
         KeyName=KEY_NAME,
         SecurityGroups=[SG_NAME]
     )
-    for instance in instances:
-        instance.wait_until_running()
-        instance.create_tags(
-            Tags=[{"Key": "Name", "Value": f"{get_random_name()}"}]
-        )
-        print(f"{instance.id}\t{instance.tags[0]['Value']} is running")
+    instances = []
+    for instance in wait_for_fleet(ec2_client, ids):
+        record = instance_record(instance)
+        print(f"{record.id}\t{record_name(record)} is {record.state}")
+        instances.append(record)
 
     return instances
 
 
-def stop_instances(ec2_resource, ec2_client, instances=None):
+def stop_instances(ec2_client, inventory, instances=None):
     """Stops all running EC2 instances in a given security group
     """
     print()
     if not instances:
-        instances = list_instances(ec2_resource, ec2_client, "running")
+        instances = list_instances(inventory, "running")
     ids = [instance.id for instance in instances]
     # If there are no running instances return immediately
     if not ids:
         print("No running instances to stop")
         return
-    response = ec2_client.stop_instances(InstanceIds=ids)
-    print(
-        f"Stop request status "
-        f"{ response['ResponseMetadata']['HTTPStatusCode'] }"
-    )
+    results = stop_fleet(ec2_client, ids)
+    inventory.invalidate()
+    print_results("Stopped", results)
+    return results
 
 
 
-def list_instances(ec2_resource, ec2_client, state=""):
-    """Prints and returns all instances in your security group
+def print_results(action, results):
+    for result in results:
+        if result.error:
+            print(f"{result.id}\tfailed: {result.error}")
+        else:
+            print(f"{result.id}\t{action} ({result.state})")
+
+
+def list_instances(inventory, state=""):
+    """Returns all instances in your security group
     in a given state or all instances if no state is specified
     """
     if state:
-        instances = ec2_client.describe_instances(
-            Filters=[
-                {"Name": "instance.group-name", "Values": [SG_NAME]},
-                {"Name": "instance-state-name", "Values": [state]}
-            ]
-        )
-    else:
-        instances = ec2_client.describe_instances(
-            Filters=[
-                {"Name": "instance.group-name", "Values": [SG_NAME]}
-            ]
-        )
+        return inventory.in_state(state)
+    return inventory.in_state()
 
-    instances = instances["Reservations"]
-    ids = [instances[i]["Instances"][0]["InstanceId"] for i in range(len(instances))]
-    instance_objs = ec2_resource.instances.filter(
-        InstanceIds=ids
-    )
-    return instance_objs
 
+def print_instances(instances):
+    for instance in instances:
+        print(
+            f"{instance.id}\t{record_name(instance)}\t{instance.state}"
+        )
 
-def terminate_stopped_instances(ec2_resource, ec2_client, instances=None):
+
+def terminate_stopped_instances(ec2_client, inventory, instances=None):
     """Terminates all stopped instances in your security group
     """
     if not instances:
-        instances = list_instances(ec2_resource, ec2_client, "stopped")
-    for instance in instances:
-        response = instance.terminate()
-        status_code = response["ResponseMetadata"]["HTTPStatusCode"]
-        if instance.tags:
-            name = instance.tags[0]["Value"]
+        instances = list_instances(inventory, "stopped")
+    if not instances:
+        return
+    names = {instance.id: record_name(instance) for instance in instances}
+    results = terminate_fleet(ec2_client, list(names), wait=False)
+    inventory.invalidate()
+    for result in results:
+        if result.error:
+            print(
+                f"Unable to terminate {names[result.id]} ({result.id}): "
+                f"{result.error}"
+            )
         else:
-            name = "No name"
-        print(
-            f"Terminated instance {name} ({instance.id}) "
-            f"with success status {status_code}"
-        )
+            print(
+                f"Terminated instance {names[result.id]} ({result.id}), "
+                f"now {result.state}"
+            )
+    return results
 
-def print_public_ips(ec2_resource, ec2_client, instances=None):
+def print_public_ips(inventory, instances=None):
     """Prints the public IP addresses of all running instances in your
     security group
     """
@@ -108,28 +124,28 @@ def print_public_ips(ec2_resource, ec2_client, instances=None):
         f"\nPublic IP addresses for instances:\n"
     )
     if not instances:
-        instances = list_instances(ec2_resource, ec2_client, "running")
+        instances = list_instances(inventory, "running")
     for instance in instances:
-        if instance.tags:
-            name = instance.tags[0]["Value"]
-        else:
-            name = "No name"
         print(
             f"{instance.id}\t"
-            f"{name}\t"
-            f"{instance.classic_address.public_ip}"
+            f"{record_name(instance)}\t"
+            f"{instance.public_ip}"
         )
 
 def main():
     """ Starting point of execution for the program
     """
-    ec2_resource = boto3.resource("ec2")
     ec2_client = boto3.client("ec2")
-    create_instances(ec2_resource, 1)
-    list_instances(ec2_resource, ec2_client)
-    print_public_ips(ec2_resource, ec2_client)
-    stop_instances(ec2_resource, ec2_client)
-    terminate_stopped_instances(ec2_resource, ec2_client)
+    inventory = Inventory(
+        ec2_client,
+        [{"Name": "instance.group-name", "Values": [SG_NAME]}]
+    )
+    create_instances(ec2_client, 1)
+    inventory.invalidate()
+    print_instances(list_instances(inventory))
+    print_public_ips(inventory)
+    stop_instances(ec2_client, inventory)
+    terminate_stopped_instances(ec2_client, inventory)
 
 
 if __name__ == "__main__":
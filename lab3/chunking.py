@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""
+Content defined chunking for delta uploads
+
+Files are cut into chunks wherever a rolling Gear hash of the preceding
+bytes matches a mask, as in FastCDC, so an insertion or append only changes
+the chunks around it and every other chunk keeps the same boundaries and
+hash. Chunks are stored once under CHUNK_PREFIX keyed by their SHA-256 and
+a file is described by its chunk list, stored under CHUNK_LIST_PREFIX.
+
+Cuts follow FastCDC with normalized chunking: no cut is considered in the
+first MIN_CHUNK bytes, the hash has to match the stricter MASK_S until the
+chunk reaches AVG_CHUNK and the looser MASK_L after that, so chunk sizes
+bunch up around AVG_CHUNK. The hash at each offset is the Gear hash of the
+WINDOW bytes before it, so a boundary depends only on the bytes around it,
+whatever they are.
+
+Hashing every byte in Python would be far too slow. Both masks include the
+low LOW_BITS bits of the hash, which only depend on the last LOW_BITS
+bytes, so those bits are worked out for a whole read at once with big
+integer arithmetic in C, a byte per offset, and bytes.find picks out the
+offsets where they're all zero. Only those offsets, one in 2 ** LOW_BITS,
+have the rest of their hash computed in Python.
+
+Chunk lists and chunks are shared by every file with the same contents, so
+deleting a file doesn't remove them. collect_garbage sweeps away chunk
+lists no row refers to and chunks no remaining list refers to.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import random
+import threading
+
+MIN_CHUNK = 256 * 1024
+AVG_CHUNK = 1024 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+READ_SIZE = 8 * 1024 * 1024
+CHUNK_PREFIX = "chunks/"
+CHUNK_LIST_PREFIX = "chunklists/"
+# Objects newer than this are never collected, a sync could be uploading
+# the file that refers to them
+GC_GRACE = 24 * 60 * 60
+DELETE_LIMIT = 1000
+
+# Fixed seed so boundaries are stable across runs and machines
+GEAR = [random.Random(5503 + i).getrandbits(64) for i in range(256)]
+WINDOW = 64
+LOW_BITS = 8
+LOW_MASK = (1 << LOW_BITS) - 1
+# Low byte of each Gear value, for bytes.translate
+GEAR_LOW = bytes(g & LOW_MASK for g in GEAR)
+# Each offset gets LANE_BITS bits of a big integer, enough that the sum of
+# LOW_BITS shifted Gear bytes can't carry into the next one
+LANE_BITS = 2 * LOW_BITS
+ZERO_LOW = b"\x00"
+
+
+def _mask(bits, seed):
+    """Returns a mask of the low LOW_BITS bits plus the rest of bits spread
+    over the higher bits of the hash, so it takes in the whole window
+    """
+    high = random.Random(seed).sample(
+        range(LOW_BITS, WINDOW), bits - LOW_BITS
+    )
+    return LOW_MASK | sum(1 << bit for bit in high)
+
+
+_AVG_BITS = AVG_CHUNK.bit_length() - 1
+MASK_S = _mask(_AVG_BITS + 2, 1)
+MASK_L = _mask(_AVG_BITS - 2, 2)
+
+
+def low_hashes(data, context=b""):
+    """Returns the low LOW_BITS bits of the Gear hash at every offset of
+    data, a byte each, where context is up to LOW_BITS - 1 bytes that came
+    before data. The hash at an offset includes the byte there
+    """
+    data = context + data
+    lanes = bytearray(len(data) * LANE_BITS // 8)
+    lanes[::LANE_BITS // 8] = data.translate(GEAR_LOW)
+    # Adds each offset's Gear byte, doubled once per step, to the LOW_BITS
+    # offsets after it, doubling the number of steps covered each time
+    total = int.from_bytes(lanes, "little")
+    step = LANE_BITS + 1
+    while step < (LANE_BITS + 1) * LOW_BITS:
+        total += total << step
+        step *= 2
+    lanes = total.to_bytes(len(lanes) + LANE_BITS * 2, "little")
+    return lanes[len(context) * LANE_BITS // 8:len(lanes) - LANE_BITS * 2:
+                 LANE_BITS // 8]
+
+
+def _matches(data, last, mask):
+    """Returns True if the Gear hash of the WINDOW bytes ending at last
+    matches mask
+    """
+    gear = GEAR
+    h = 0
+    # The low 16 bits only need the last 16 bytes, which rules out most
+    # candidates for a quarter of the work
+    for b in data[max(last - 15, 0):last + 1]:
+        h = (h << 1) + gear[b]
+    if h & mask & 0xFFFF:
+        return False
+    h = 0
+    for b in data[max(last - WINDOW + 1, 0):last + 1]:
+        h = (h << 1) + gear[b]
+    return not h & mask
+
+
+def _find_cut(data, lows, first, stop, mask):
+    """Returns the offset of the first byte in data[first:stop] the hash
+    after which matches mask, or -1
+    """
+    last = lows.find(ZERO_LOW, first, stop)
+    while last >= 0 and not _matches(data, last, mask):
+        last = lows.find(ZERO_LOW, last + 1, stop)
+    return last
+
+
+def cut_point(data, lows, start, eof, min_size=MIN_CHUNK,
+              avg_size=AVG_CHUNK, max_size=MAX_CHUNK):
+    """Returns the length of the chunk starting at start in data, or None
+    if more data is needed to decide and eof hasn't been reached. lows is
+    low_hashes of data
+    """
+    n = len(data) - start
+    if n <= min_size:
+        return n if eof else None
+    end = start + min(n, max_size)
+    last = _find_cut(
+        data, lows, start + min_size - 1, min(start + avg_size - 1, end),
+        MASK_S
+    )
+    if last < 0 and end > start + avg_size - 1:
+        last = _find_cut(data, lows, start + avg_size - 1, end, MASK_L)
+    if last >= 0:
+        return last + 1 - start
+    if end - start == max_size or eof:
+        return end - start
+    return None
+
+
+def iter_chunks(infile, min_size=MIN_CHUNK, avg_size=AVG_CHUNK,
+                max_size=MAX_CHUNK):
+    """Yields the content defined chunks of a file opened for reading"""
+    buf = bytearray()
+    lows = bytearray()
+    start = 0
+    eof = False
+    while start < len(buf) or not eof:
+        if not eof and len(buf) - start < max_size:
+            # Drop what's been yielded once it's worth the move
+            if start >= READ_SIZE:
+                del buf[:start]
+                del lows[:start]
+                start = 0
+            data = infile.read(READ_SIZE)
+            eof = not data
+            lows += low_hashes(data, bytes(buf[-(LOW_BITS - 1):]))
+            buf += data
+            continue
+        cut = cut_point(buf, lows, start, eof, min_size, avg_size, max_size)
+        if not cut:
+            break
+        yield bytes(buf[start:start + cut])
+        start += cut
+
+
+def chunk_key(digest):
+    return f"{CHUNK_PREFIX}{digest}"
+
+
+def chunk_list_key(file_hash):
+    return f"{CHUNK_LIST_PREFIX}{file_hash}.json"
+
+
+class ChunkStore:
+    """Uploads the chunks of files to a bucket, skipping chunks that are
+    already there. The chunks in the bucket are listed once, the first time
+    they're needed
+    """
+
+    def __init__(self, s3_client, bucket, list_objects):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self._list_objects = list_objects
+        self._known = None
+        self._lock = threading.Lock()
+
+    def _known_chunks(self):
+        with self._lock:
+            if self._known is None:
+                self._known = {
+                    obj["Key"][len(CHUNK_PREFIX):]
+                    for obj in self._list_objects(
+                        self.s3_client, self.bucket, CHUNK_PREFIX
+                    )
+                }
+            return self._known
+
+    def _claim(self, digest):
+        """Returns True if the caller should upload the chunk digest"""
+        known = self._known_chunks()
+        with self._lock:
+            if digest in known:
+                return False
+            known.add(digest)
+            return True
+
+    def upload(self, path):
+        """Uploads the chunks of path that aren't already stored followed
+        by its chunk list. The list is stored under the MD5 of the bytes
+        that were chunked, which is returned along with them since the file
+        may have changed since it was last hashed. Returns (chunk list key,
+        bytes uploaded, MD5, size)
+        """
+        chunks = []
+        uploaded = 0
+        size = 0
+        md5 = hashlib.md5()
+        with open(path, "rb") as infile:
+            for chunk in iter_chunks(infile):
+                md5.update(chunk)
+                size += len(chunk)
+                digest = hashlib.sha256(chunk).hexdigest()
+                chunks.append([digest, len(chunk)])
+                if self._claim(digest):
+                    try:
+                        self.s3_client.put_object(
+                            Bucket=self.bucket,
+                            Key=chunk_key(digest),
+                            Body=chunk
+                        )
+                    except Exception:
+                        with self._lock:
+                            self._known.discard(digest)
+                        raise
+                    uploaded += len(chunk)
+        file_hash = md5.hexdigest()
+        key = chunk_list_key(file_hash)
+        body = json.dumps(chunks).encode("utf-8")
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body)
+        return key, uploaded + len(body), file_hash, size
+
+
+def load_chunk_list(s3_client, bucket, key):
+    """Returns [(sha256, size), ...] for the chunk list stored at key"""
+    body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    return [tuple(chunk) for chunk in json.loads(body)]
+
+
+def _delete_keys(s3_client, bucket, keys):
+    for start in range(0, len(keys), DELETE_LIMIT):
+        s3_client.delete_objects(
+            Bucket=bucket,
+            Delete={
+                "Objects": [
+                    {"Key": key} for key in keys[start:start + DELETE_LIMIT]
+                ],
+                "Quiet": True
+            }
+        )
+
+
+def collect_garbage(s3_client, bucket, chunk_lists, list_objects,
+                    keep=(), grace=GC_GRACE):
+    """Deletes the chunk lists not in chunk_lists, the chunk list keys
+    every row refers to, then the chunks none of the remaining lists refer
+    to. Objects modified in the last grace seconds, or with keys in keep,
+    like files uploaded under a directory called chunks, are left alone.
+    Returns (chunk lists removed, chunks removed)
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=grace)
+    live = set()
+    dead_lists = []
+    for obj in list_objects(s3_client, bucket, CHUNK_LIST_PREFIX):
+        if obj["Key"] in chunk_lists:
+            live.update(
+                digest for digest, _ in
+                load_chunk_list(s3_client, bucket, obj["Key"])
+            )
+        elif obj["LastModified"] < cutoff and obj["Key"] not in keep:
+            dead_lists.append(obj["Key"])
+    dead_chunks = [
+        obj["Key"] for obj in list_objects(s3_client, bucket, CHUNK_PREFIX)
+        if obj["Key"][len(CHUNK_PREFIX):] not in live
+        and obj["LastModified"] < cutoff and obj["Key"] not in keep
+    ]
+    _delete_keys(s3_client, bucket, dead_lists)
+    _delete_keys(s3_client, bucket, dead_chunks)
+    return len(dead_lists), len(dead_chunks)
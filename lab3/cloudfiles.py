@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Batched access to the CloudFiles DynamoDB table described in schema.json
+
+The table is keyed by owner and path, so everything a sync needs lives in a
+single partition. query_manifest reads that partition once up front, and
+rows are otherwise read with BatchGetItem and written with BatchWriteItem so
+a sync costs a handful of DynamoDB calls per hundred files rather than two
+or three per file. Anything DynamoDB hands back as unprocessed is retried
+with exponential backoff.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+import random
+import time
+from boto3.dynamodb.conditions import Key
+
+DYNAMO_URL = "http://localhost:8000"
+TABLE_NAME = "CloudFiles"
+OWNER = 'david.glance'
+
+BATCH_GET_LIMIT = 100
+BATCH_WRITE_LIMIT = 25
+MAX_RETRIES = 8
+BASE_BACKOFF = 0.05
+MAX_BACKOFF = 5
+
+
+def backoff(attempt):
+    """Sleeps for a randomised, exponentially growing interval"""
+    time.sleep(random.uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt)))
+
+
+def _retry_unprocessed(call, request, unprocessed_key):
+    """Repeats call until DynamoDB has processed every part of request,
+    yielding each response along the way
+    """
+    attempt = 0
+    while request:
+        resp = call(RequestItems=request)
+        yield resp
+        request = resp.get(unprocessed_key) or {}
+        if request:
+            if attempt >= MAX_RETRIES:
+                raise RuntimeError(
+                    f"DynamoDB left requests unprocessed after "
+                    f"{MAX_RETRIES} retries"
+                )
+            backoff(attempt)
+            attempt += 1
+
+
+def file_key(path, owner=OWNER):
+    return {"owner": owner, "path": path}
+
+
+def batch_get_items(dynamo, paths, owner=OWNER, table_name=TABLE_NAME):
+    """Returns a dict mapping each path in paths that has a row in the
+    table to that row
+    """
+    paths = list(dict.fromkeys(paths))
+    found = {}
+    for start in range(0, len(paths), BATCH_GET_LIMIT):
+        keys = [
+            file_key(path, owner)
+            for path in paths[start:start + BATCH_GET_LIMIT]
+        ]
+        request = {table_name: {"Keys": keys}}
+        for resp in _retry_unprocessed(
+            dynamo.batch_get_item, request, "UnprocessedKeys"
+        ):
+            for item in resp["Responses"].get(table_name, []):
+                found[item["path"]] = item
+    return found
+
+
+def query_manifest(dynamo, owner=OWNER, table_name=TABLE_NAME):
+    """Returns a dict mapping every path in owner's partition to its row,
+    paging through the whole partition with Query
+    """
+    table = dynamo.Table(table_name)
+    manifest = {}
+    kwargs = {"KeyConditionExpression": Key("owner").eq(owner)}
+    while True:
+        resp = table.query(**kwargs)
+        for item in resp["Items"]:
+            manifest[item["path"]] = item
+        last_key = resp.get("LastEvaluatedKey")
+        if not last_key:
+            return manifest
+        kwargs["ExclusiveStartKey"] = last_key
+
+
+def _batch_write(dynamo, requests, table_name):
+    requests = list(requests)
+    for start in range(0, len(requests), BATCH_WRITE_LIMIT):
+        request = {table_name: requests[start:start + BATCH_WRITE_LIMIT]}
+        for _ in _retry_unprocessed(
+            dynamo.batch_write_item, request, "UnprocessedItems"
+        ):
+            pass
+
+
+def batch_write_items(dynamo, items, table_name=TABLE_NAME):
+    """Puts every row in items, overwriting any existing row with the
+    same key
+    """
+    _batch_write(
+        dynamo, ({"PutRequest": {"Item": item}} for item in items), table_name
+    )
+
+
+def batch_delete_items(dynamo, paths, owner=OWNER, table_name=TABLE_NAME):
+    _batch_write(
+        dynamo,
+        ({"DeleteRequest": {"Key": file_key(path, owner)}} for path in paths),
+        table_name
+    )
+
+
+# Fields describing how a file's contents are stored when it isn't simply
+# the object at its path
+STORAGE_FIELDS = (
+    "storage", "size", "chunkList", "contentKey", "packKey", "packOffset",
+    "packLength"
+)
+
+
+def storage_of(item):
+    return item.get("storage", "path")
+
+
+def stored_item(item, storage="path", **fields):
+    """Returns item with its storage fields replaced by storage and fields
+    """
+    item = {k: v for k, v in item.items() if k not in STORAGE_FIELDS}
+    if storage != "path":
+        item.update(storage=storage, **fields)
+    return item
+
+
+def new_item(path, fname, modtime, file_hash, owner=OWNER):
+    return {
+        "owner": owner,
+        "path": path,
+        "lastUpdated": modtime,
+        "permissions": "",
+        "fileName": fname,
+        "md5Hash": file_hash
+    }
+
+
+def updated_item(item, modtime, file_hash):
+    return {**item, "lastUpdated": modtime, "md5Hash": file_hash}
@@ -6,40 +6,103 @@ to S3 preserving the structure using S3 filenames
 __author__ = "Eddie Atkinson"
 __copyright__ = "Copyright 2020"
 """
+from collections import namedtuple
 from datetime import datetime
 import os
 import boto3
 import base64
 import getopt
 import sys
+import threading
 from pprint import pprint
-import hashlib
 from botocore.exceptions import ClientError
 
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from common.compression import (
+    CODEC_METADATA, compress_chunks, file_codec, read_file
+)
+from common.hashing import verified_chunks
+from common.multipart import upload_stream
+from common.scanner import PathFilter, DEFAULT_EXCLUDES, scan, scan_paths
+from common.statcache import StatCache
+from syncengine import Pipeline, SyncStats, DEFAULT_QUEUE_SIZE
+from cloudfiles import (
+    DYNAMO_URL, BATCH_GET_LIMIT, BATCH_WRITE_LIMIT, batch_get_items,
+    batch_write_items, batch_delete_items, query_manifest, new_item,
+    updated_item, stored_item, storage_of
+)
+from chunking import ChunkStore, collect_garbage as collect_chunks
+from contentstore import ContentStore, content_hash
+from packing import PackWriter, PACK_THRESHOLD, packed_files
+from s3lister import iter_objects
+from watcher import debounced, open_watcher
+
 ROOT_DIR = '.'
 ROOT_S3_DIR = '22487668-test'
-SHORT_ARGS = "ih"
-LONG_ARGS = ["initialise", "help"]
-DYNAMO_URL = "http://localhost:8000"
-TABLE_NAME = "CloudFiles"
-OWNER = 'david.glance'
+SHORT_ARGS = "ihj:ndrcagpzwx:I:"
+LONG_ARGS = [
+    "initialise", "help", "jobs=", "no-manifest", "delete", "rehash",
+    "chunked", "dedupe", "gc", "pack", "compress", "watch", "exclude=",
+    "include="
+]
+DEFAULT_JOBS = 8
+S3_DELETE_LIMIT = 1000
+# Files at least this big are uploaded in content defined chunks with -c
+CHUNK_THRESHOLD = 8 * 1024 * 1024
 
 bucket_config = {'LocationConstraint': 'ap-southeast-2'}
 
-def md5_hash(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as infile:
-        for chunk in iter(lambda: infile.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+FileRecord = namedtuple(
+    "FileRecord", ["path", "fname", "size", "modtime", "hash"]
+)
+
+# boto3 resources are not thread safe so each worker gets its own resource
+_thread_state = threading.local()
+
 
+def get_dynamo():
+    dynamo = getattr(_thread_state, "dynamo", None)
+    if dynamo is None:
+        dynamo = boto3.session.Session().resource(
+            "dynamodb", endpoint_url=DYNAMO_URL
+        )
+        _thread_state.dynamo = dynamo
+    return dynamo
 
-def upload_file(s3_resource, path, hash, modtime):
+def upload_file(s3_client, path, hash, modtime, key=None, compress=False,
+                verify=False):
+    """Uploads path to key, or to path if no key is given. With compress
+    the file is compressed on the way up if a sample of it compresses well.
+    With verify the file is hashed as it's sent and the upload abandoned
+    if it no longer matches hash, for keys named after the hash
+    """
+    codec = file_codec(path) if compress else None
+    if codec or verify:
+        chunks = read_file(path)
+        metadata = {"ModificationTime": modtime, "Md5Hash": hash}
+        if verify:
+            chunks = verified_chunks(chunks, hash, path)
+        if codec:
+            print(f"Uploading  { path } compressed with {codec}")
+            chunks = compress_chunks(chunks, codec)
+            metadata[CODEC_METADATA] = codec
+        else:
+            print(f"Uploading  { path }")
+        upload_stream(
+            s3_client,
+            ROOT_S3_DIR,
+            key or path,
+            chunks,
+            extra_args={"Metadata": metadata}
+        )
+        return
     print(f"Uploading  { path }")
-    s3_resource.meta.client.upload_file(
+    s3_client.upload_file(
                         Filename=path,
                         Bucket=ROOT_S3_DIR,
-                        Key=path,
+                        Key=key or path,
                         ExtraArgs={
                             "Metadata": {
                                 "ModificationTime": modtime,
@@ -54,74 +117,343 @@ def print_help():
         f"Usage cloudstorage.py [OPTION]\n"
         f"Uploads the files in a given directory to S3\n"
         f"-i, --initialise\tCreate a new S3 bucket\n"
+        f"-j, --jobs N\tNumber of workers per stage (default {DEFAULT_JOBS})\n"
+        f"-n, --no-manifest\tLook files up in batches instead of "
+        f"prefetching the whole manifest\n"
+        f"-d, --delete\tRemove files deleted locally from S3 and DynamoDB\n"
+        f"-r, --rehash\tHash every file even if the stat cache says it's "
+        f"unchanged\n"
+        f"-c, --chunked\tOnly upload the changed chunks of large files\n"
+        f"-a, --dedupe\tStore files by content so identical files are "
+        f"only uploaded once\n"
+        f"-g, --gc\tRemove stored contents and chunks no file refers to "
+        f"any more\n"
+        f"-p, --pack\tUpload files under {PACK_THRESHOLD} bytes together "
+        f"in packs\n"
+        f"-z, --compress\tCompress files that compress well before "
+        f"uploading them\n"
+        f"-w, --watch\tKeep running and upload files as they change\n"
+        f"-x, --exclude GLOB\tSkip files and directories matching GLOB, "
+        f"as well as {', '.join(DEFAULT_EXCLUDES)}\n"
+        f"-I, --include GLOB\tOnly upload files matching GLOB\n"
         f"-h, --help\tDisplay this help menu then quit\n"
     )
 
 
-def create_item(table, modtime, path, hash, fname):
-    print(f"Creating DB entry for {path}")
-    item = {
-        "owner": OWNER,
-        "path": path,
-        "lastUpdated": modtime,
-        "permissions": "",
-        "fileName": fname,
-        "md5Hash": hash
-    }
-    table.put_item(Item=item)
-
-def update_item(table, modtime, path, hash):
-    key = {
-        "owner": OWNER,
-        "path": path
-    }
-    resp = table.get_item(Key=key)
-    item = resp["Item"]
-    print(
-        f"Updating {path}"
-    )
-    table.update_item(
-        Key=key,
-        UpdateExpression="set md5Hash=:h, lastUpdated=:l",
-        ExpressionAttributeValues={
-            ":h": hash,
-            ":l": modtime
-        },
-        ReturnValues="UPDATED_NEW"
+def hash_stage(stats, cache):
+    def hash_file(entry):
+        path, fname, st = entry
+        print(path + '\n')
+        modtime = datetime.fromtimestamp(st.st_mtime).strftime("%c")
+        stats.scanned(st.st_size)
+        return FileRecord(
+            path, fname, st.st_size, modtime, cache.hash(path, st)
+        )
+    return hash_file
+
+
+def walk_unseen(source, unseen):
+    """Passes source through, discarding each path it yields from unseen so
+    that whatever is left over once the walk is done wasn't seen locally
+    """
+    for entry in source:
+        unseen.discard(entry[0])
+        yield entry
+
+
+def check_stage(manifest):
+    """Returns a batch stage that compares records against the prefetched
+    manifest, or against DynamoDB in batches if there is no manifest. The
+    stage yields (record, row) for each new or changed file where row is
+    what to write once it's uploaded
+    """
+    def check(records):
+        if manifest is None:
+            items = batch_get_items(
+                get_dynamo(), [record.path for record in records]
+            )
+        else:
+            items = manifest
+        return changed_records(records, items)
+    return check
+
+
+def changed_records(records, items):
+    changed = []
+    for record in records:
+        item = items.get(record.path)
+        if item is None:
+            row = new_item(
+                record.path, record.fname, record.modtime, record.hash
+            )
+        elif item["md5Hash"] == record.hash:
+            # Nothing has changed, no need to upload
+            print(f"{record.path} is unchanged no need to upload")
+            continue
+        else:
+            row = updated_item(item, record.modtime, record.hash)
+        changed.append((record, row))
+    return changed
+
+
+def upload_stage(s3_client, stats, chunk_store=None, content_store=None,
+                 pack_writer=None, compress=False):
+    """Returns a stage that uploads each changed file and yields (row,
+    released) where released is the hash of the stored contents the old
+    row referred to, if any, to let go of once row has been written. Small
+    files handed to pack_writer are recorded when their pack is stored.
+    Chunks and packs are never compressed, so they can be read by range
+    """
+    def upload(change):
+        record, row = change
+        released = content_hash(row)
+        if chunk_store is not None and record.size >= CHUNK_THRESHOLD:
+            print(f"Uploading  { record.path } in chunks")
+            chunk_list, sent, file_hash, size = chunk_store.upload(
+                record.path
+            )
+            stats.uploaded(sent)
+            # The row has to describe the bytes that were chunked
+            if file_hash != record.hash:
+                print(f"{record.path} changed while it was being uploaded")
+                row = {**row, "md5Hash": file_hash}
+            return stored_item(
+                row, "chunks", size=size, chunkList=chunk_list
+            ), released
+        if pack_writer is not None and record.size < PACK_THRESHOLD:
+            pack_writer.add(record.path, row, released)
+            return None
+        if content_store is not None:
+            key, uploaded = content_store.upload(
+                record.hash,
+                lambda key: upload_file(
+                    s3_client, record.path, record.hash, record.modtime, key,
+                    compress, verify=True
+                )
+            )
+            if uploaded:
+                stats.uploaded(record.size)
+            else:
+                print(f"{record.path} is already stored as {key}")
+            return stored_item(
+                row, "cas", size=record.size, contentKey=key
+            ), released
+        upload_file(
+            s3_client, record.path, record.hash, record.modtime,
+            compress=compress
+        )
+        stats.uploaded(record.size)
+        return stored_item(row), released
+    return upload
+
+
+def record_stage(content_store):
+    def record(changes):
+        rows = [row for row, _ in changes]
+        for row in rows:
+            print(f"Recording DB entry for {row['path']}")
+        batch_write_items(get_dynamo(), rows)
+        content_store.release(
+            released for _, released in changes if released
+        )
+    return record
+
+
+def delete_remote(s3_client, paths, manifest, content_store):
+    """Deletes the objects and DynamoDB rows for paths, letting go of any
+    stored contents they referred to. Their chunks are shared, so they're
+    left for -g to sweep up
+    """
+    paths = sorted(paths)
+    for start in range(0, len(paths), S3_DELETE_LIMIT):
+        s3_client.delete_objects(
+            Bucket=ROOT_S3_DIR,
+            Delete={
+                "Objects": [
+                    {"Key": path}
+                    for path in paths[start:start + S3_DELETE_LIMIT]
+                ],
+                "Quiet": True
+            }
+        )
+    batch_delete_items(get_dynamo(), paths)
+    content_store.release(
+        file_hash for file_hash in map(content_hash, map(manifest.get, paths))
+        if file_hash
     )
 
 
-def changes_made(table, modtime, path, hash, fname):
-    resp = table.get_item(
-        Key={
-            "owner": OWNER,
-            "path": path
+def packed_stage(stats, record):
+    """Returns the on_packed callback recording the files in each pack"""
+    def packed(changes, uploaded):
+        if uploaded:
+            for row, _ in changes:
+                stats.uploaded(row["packLength"])
+        record(changes)
+    return packed
+
+
+def pack_failed_stage(stats):
+    """Returns the on_failed callback counting each file in a pack that
+    couldn't be stored as an error of its own. Their rows aren't written,
+    so they're packed again on the next sync
+    """
+    def failed(changes, error):
+        print(f"Failed to upload a pack of {len(changes)} files: {error}")
+        for row, _ in changes:
+            stats.error()
+            print(f"Failed to upload {row['path']}")
+    return failed
+
+
+def sync(s3_client, cache, jobs, content_store, manifest=None,
+         chunk_store=None, dedupe=False, pack=False, compress=False,
+         path_filter=None, source=None):
+    """Runs the local tree, or the (path, name, stat) items in source,
+    through the hash -> check -> upload -> record pipeline and returns the
+    stats for the run along with the paths in the manifest that no longer
+    exist locally. Paths the filter leaves out aren't counted as deleted, and
+    if any of the tree couldn't be scanned nothing is
+    """
+    stats = SyncStats()
+    scan_errors = []
+    if source is None:
+        source = scan(ROOT_DIR, path_filter, errors=scan_errors)
+    deleted = set()
+    if manifest is not None:
+        path_filter = path_filter or PathFilter()
+        # The scan never yields files directly in the root either
+        deleted = {
+            path for path in manifest
+            if "/" in path and path_filter.wanted_path(path)
         }
+        source = walk_unseen(source, deleted)
+    record = record_stage(content_store)
+    pack_writer = None
+    if pack:
+        pack_writer = PackWriter(
+            content_store, packed_stage(stats, record),
+            pack_failed_stage(stats),
+            packed=packed_files(manifest) if dedupe else None
+        )
+    pipeline = Pipeline(queue_size=DEFAULT_QUEUE_SIZE, stats=stats)
+    pipeline.add_stage("hash", hash_stage(stats, cache), workers=jobs)
+    pipeline.add_stage(
+        "check", check_stage(manifest), workers=jobs,
+        batch_size=BATCH_GET_LIMIT
+    )
+    pipeline.add_stage(
+        "upload",
+        upload_stage(
+            s3_client, stats, chunk_store, content_store if dedupe else None,
+            pack_writer, compress
+        ),
+        workers=jobs
     )
+    pipeline.add_stage(
+        "record", record, workers=jobs, batch_size=BATCH_WRITE_LIMIT
+    )
+    pipeline.run(source)
+    if pack_writer is not None:
+        pack_writer.flush()
+    for _ in scan_errors:
+        stats.error()
+    if scan_errors and deleted:
+        print(
+            f"{len(scan_errors)} paths couldn't be scanned, not treating "
+            f"{len(deleted)} missing files as deleted"
+        )
+        deleted = set()
+    return stats, deleted
+
+
+def watch(s3_client, cache, jobs, content_store, use_manifest, delete,
+          **options):
+    """Syncs the tree then keeps syncing whatever changes in it, only
+    walking the whole tree again when the watcher can't say what changed.
+    Changed files are looked up in DynamoDB rather than a manifest since
+    a manifest would go stale as soon as the first batch was uploaded
+    """
+    watcher = open_watcher(ROOT_DIR)
     try:
-        item = resp["Item"]
-        if item["md5Hash"] == hash:
-            # Nothing has changed, return False
-            print(f"{path} is unchanged no need to upload")
-            return False
-        else:
-            update_item(table, modtime, path, hash)
-    except KeyError:
-        # Theres no DB entry for the item, create one
-        create_item(table, modtime, path, hash, fname)
-        return True
-    return True
+        rescan = True
+        paths = set()
+        for_batches = debounced(watcher)
+        while True:
+            if rescan:
+                manifest = None
+                if use_manifest:
+                    manifest = query_manifest(get_dynamo())
+                stats, deleted = sync(
+                    s3_client, cache, jobs, content_store, manifest,
+                    **options
+                )
+            else:
+                entries, missing = scan_paths(
+                    ROOT_DIR, paths, options.get("path_filter")
+                )
+                stats, _ = sync(
+                    s3_client, cache, jobs, content_store, source=entries,
+                    **options
+                )
+                deleted = set(missing)
+                manifest = batch_get_items(get_dynamo(), list(deleted))
+                deleted.intersection_update(manifest)
+            for path in sorted(deleted):
+                print(f"{path} has been deleted locally")
+            if deleted and delete:
+                delete_remote(s3_client, deleted, manifest, content_store)
+            cache.flush()
+            print(stats.summary())
+            print("Watching for changes")
+            paths, rescan = next(for_batches)
+    finally:
+        watcher.close()
+
 
 def main():
     opts, args = getopt.getopt(sys.argv[1:], SHORT_ARGS, LONG_ARGS)
     initialise = False
+    jobs = DEFAULT_JOBS
+    use_manifest = True
+    delete = False
+    rehash = False
+    chunk_store = None
+    dedupe = False
+    collect = False
+    pack = False
+    compress = False
+    watching = False
+    includes = []
+    excludes = list(DEFAULT_EXCLUDES)
     s3_client = boto3.client("s3")
-    s3_resource = boto3.resource("s3")
-    dynamo = boto3.resource("dynamodb", endpoint_url=DYNAMO_URL)
-    table = dynamo.Table(TABLE_NAME)
     for opt in opts:
         if opt[0] == '-i' or opt[0] == '--initalise':
             initialise = True
+        elif opt[0] == '-j' or opt[0] == '--jobs':
+            jobs = max(1, int(opt[1]))
+        elif opt[0] == '-n' or opt[0] == '--no-manifest':
+            use_manifest = False
+        elif opt[0] == '-d' or opt[0] == '--delete':
+            delete = True
+        elif opt[0] == '-r' or opt[0] == '--rehash':
+            rehash = True
+        elif opt[0] == '-c' or opt[0] == '--chunked':
+            chunk_store = ChunkStore(s3_client, ROOT_S3_DIR, iter_objects)
+        elif opt[0] == '-a' or opt[0] == '--dedupe':
+            dedupe = True
+        elif opt[0] == '-g' or opt[0] == '--gc':
+            collect = True
+        elif opt[0] == '-p' or opt[0] == '--pack':
+            pack = True
+        elif opt[0] == '-z' or opt[0] == '--compress':
+            compress = True
+        elif opt[0] == '-w' or opt[0] == '--watch':
+            watching = True
+        elif opt[0] == '-x' or opt[0] == '--exclude':
+            excludes.append(opt[1])
+        elif opt[0] == '-I' or opt[0] == '--include':
+            includes.append(opt[1])
         elif opt[0] == '-h' or opt[0] == '--help':
             print_help()
             return
@@ -140,20 +472,52 @@ def main():
         print(f"Bucket {ROOT_S3_DIR} has already been created by you")
         return
 
+    content_store = ContentStore(s3_client, ROOT_S3_DIR, get_dynamo)
+    path_filter = PathFilter(includes, excludes)
+    if watching:
+        with StatCache(ROOT_DIR, rehash=rehash) as cache:
+            try:
+                watch(
+                    s3_client, cache, jobs, content_store, use_manifest,
+                    delete, chunk_store=chunk_store, dedupe=dedupe,
+                    pack=pack, compress=compress, path_filter=path_filter
+                )
+            except KeyboardInterrupt:
+                print("Stopped watching")
+        return
+
+    manifest = None
+    if use_manifest:
+        manifest = query_manifest(get_dynamo())
+        print(f"Fetched {len(manifest)} entries from the manifest")
+
     # parse directory and upload files
 
-    for dir_name, subdir_list, file_list in os.walk(ROOT_DIR, topdown=True):
-        if dir_name != ROOT_DIR:
-            for fname in file_list:
-                path = f"{dir_name[2:]}/{fname}"
-                print(path + '\n')
-                modtime = datetime.fromtimestamp(
-                    os.stat(path).st_mtime
-                ).strftime("%c")
-                hash = md5_hash(path)
-                if changes_made(table, modtime, path, hash, fname):
-                    upload_file(s3_resource, path, hash, modtime)
+    with StatCache(ROOT_DIR, rehash=rehash) as cache:
+        stats, deleted = sync(
+            s3_client, cache, jobs, content_store, manifest, chunk_store,
+            dedupe, pack, compress, path_filter
+        )
+    for path in sorted(deleted):
+        print(f"{path} has been deleted locally")
+    if deleted and delete:
+        print(f"Removing {len(deleted)} deleted files from S3")
+        delete_remote(s3_client, deleted, manifest, content_store)
+    if collect:
+        removed = content_store.collect_garbage()
+        print(f"Removed {removed} unreferenced objects")
+        # Rows written by this sync refer to chunks too
+        rows = query_manifest(get_dynamo())
+        chunk_lists = {
+            row["chunkList"] for row in rows.values()
+            if storage_of(row) == "chunks"
+        }
+        lists, chunks = collect_chunks(
+            s3_client, ROOT_S3_DIR, chunk_lists, iter_objects, keep=rows
+        )
+        print(f"Removed {lists} unreferenced chunk lists and {chunks} chunks")
     print("done")
+    print(stats.summary())
 
 if __name__ == "__main__":
     main()
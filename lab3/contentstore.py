@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Content addressed storage with reference counting
+
+In content addressed mode a file's contents are stored once under
+OBJECT_PREFIX keyed by their MD5, and CloudFiles rows point at that object
+instead of an object at their own path. Every owner shares the same
+objects, so identical files anywhere are only uploaded and stored once.
+Packs of small files are stored the same way, with one reference for each
+file in the pack.
+
+Each object has a reference count kept in the CloudFiles table under the
+OBJECTS_OWNER partition. A row taking a reference increments it before the
+object is uploaded and a row letting go decrements it after it has been
+rewritten, so a crash can only ever leave a count too high, never too low.
+Objects whose count has dropped to zero are removed by collect_garbage.
+
+collect_garbage marks a counter as deleting before it removes the object
+and only drops the counter after, and no reference can be taken to a
+counter marked deleting. upload waits for the mark to go, then finds no
+counter and uploads the object again. A mark left behind by a collector
+that died partway through is cleared once it's DELETE_TIMEOUT old.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+import time
+from boto3.dynamodb.conditions import Attr, Key
+from cloudfiles import TABLE_NAME, backoff, file_key, storage_of
+
+OBJECT_PREFIX = "objects/"
+OBJECTS_OWNER = "#objects"
+DELETE_TIMEOUT = 10 * 60
+
+
+def content_key(file_hash):
+    return f"{OBJECT_PREFIX}{file_hash}"
+
+
+def content_hash(item):
+    """Returns the hash of the object a CloudFiles row refers to, or None if
+    the row isn't content addressed or packed
+    """
+    storage = storage_of(item)
+    if storage == "cas":
+        return item["contentKey"][len(OBJECT_PREFIX):]
+    if storage == "pack":
+        return item["packKey"][len(OBJECT_PREFIX):]
+    return None
+
+
+class ContentStore:
+    def __init__(self, s3_client, bucket, get_dynamo, table_name=TABLE_NAME):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.get_dynamo = get_dynamo
+        self.table_name = table_name
+
+    def _table(self):
+        return self.get_dynamo().Table(self.table_name)
+
+    def _add(self, file_hash, delta):
+        return self._table().update_item(
+            Key=file_key(file_hash, OBJECTS_OWNER),
+            UpdateExpression="ADD refCount :d",
+            ExpressionAttributeValues={":d": delta},
+            ReturnValues="ALL_NEW"
+        )["Attributes"]
+
+    def _take(self, file_hash, refs):
+        """Adds refs to the object's count once no collector is deleting
+        it, returning the counter
+        """
+        table = self._table()
+        attempt = 0
+        while True:
+            try:
+                return table.update_item(
+                    Key=file_key(file_hash, OBJECTS_OWNER),
+                    UpdateExpression="ADD refCount :d",
+                    ConditionExpression=Attr("deleting").not_exists(),
+                    ExpressionAttributeValues={":d": refs},
+                    ReturnValues="ALL_NEW"
+                )["Attributes"]
+            except table.meta.client.exceptions.\
+                    ConditionalCheckFailedException:
+                pass
+            counter = table.get_item(
+                Key=file_key(file_hash, OBJECTS_OWNER)
+            ).get("Item", {})
+            marked = counter.get("deleting")
+            if marked is not None and time.time() - float(marked) > \
+                    DELETE_TIMEOUT:
+                # The collector that marked it never finished
+                self._forget(file_hash, marked)
+            else:
+                backoff(attempt)
+                attempt += 1
+
+    def _forget(self, file_hash, marked):
+        """Drops the counter if it still has the deleting mark marked"""
+        table = self._table()
+        try:
+            table.delete_item(
+                Key=file_key(file_hash, OBJECTS_OWNER),
+                ConditionExpression=Attr("deleting").eq(marked)
+            )
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass
+
+    def upload(self, file_hash, put, refs=1):
+        """Takes refs references to the object with the given hash, calling
+        put(key) to upload it first if nobody has stored it yet. Returns
+        (key, whether it was uploaded)
+        """
+        key = content_key(file_hash)
+        counter = self._take(file_hash, refs)
+        if counter.get("stored"):
+            return key, False
+        try:
+            put(key)
+            self._table().update_item(
+                Key=file_key(file_hash, OBJECTS_OWNER),
+                UpdateExpression="SET stored = :t",
+                ExpressionAttributeValues={":t": True}
+            )
+        except Exception:
+            self._add(file_hash, -refs)
+            raise
+        return key, True
+
+    def release(self, file_hashes):
+        """Drops one reference to each object in file_hashes"""
+        for file_hash in file_hashes:
+            self._add(file_hash, -1)
+
+    def collect_garbage(self):
+        """Deletes every object nothing refers to any more, returning how
+        many were removed
+        """
+        table = self._table()
+        kwargs = {
+            "KeyConditionExpression": Key("owner").eq(OBJECTS_OWNER),
+            "FilterExpression": Attr("refCount").lte(0)
+        }
+        removed = 0
+        while True:
+            resp = table.query(**kwargs)
+            for item in resp["Items"]:
+                file_hash = item["path"]
+                marked = int(time.time())
+                try:
+                    # Only delete the object if it's still unreferenced, and
+                    # stop anyone taking a reference until it's gone
+                    table.update_item(
+                        Key=file_key(file_hash, OBJECTS_OWNER),
+                        UpdateExpression="SET deleting = :m",
+                        ConditionExpression=Attr("refCount").lte(0) & (
+                            Attr("deleting").not_exists()
+                            | Attr("deleting").lt(marked - DELETE_TIMEOUT)
+                        ),
+                        ExpressionAttributeValues={":m": marked}
+                    )
+                except table.meta.client.exceptions.\
+                        ConditionalCheckFailedException:
+                    continue
+                print(f"Removing unreferenced object {file_hash}")
+                self.s3_client.delete_object(
+                    Bucket=self.bucket, Key=content_key(file_hash)
+                )
+                self._forget(file_hash, marked)
+                removed += 1
+            last_key = resp.get("LastEvaluatedKey")
+            if not last_key:
+                return removed
+            kwargs["ExclusiveStartKey"] = last_key
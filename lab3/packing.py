@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Packs small files together into shared objects
+
+Uploading a tree of tiny files one object each spends far more on requests
+than on data, so with packing enabled files smaller than PACK_THRESHOLD are
+appended to an in-memory pack instead. Once a pack reaches PACK_SIZE it's
+stored through the ContentStore as a single object, referenced once by
+every file in it, and each file's row records where in the pack its bytes
+are so it can be restored with a ranged GET.
+
+When deduplicating, PackWriter keeps the hash of every file it has packed,
+seeded from the manifest, so a file identical to one already packed isn't
+packed again. Its row points at the bytes already in a pack instead,
+taking a reference to that pack, or shares them if they're in the pack
+still being filled.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+import hashlib
+import threading
+from cloudfiles import stored_item, storage_of
+from contentstore import content_hash
+
+PACK_SIZE = 32 * 1024 * 1024
+PACK_THRESHOLD = 1024 * 1024
+
+
+class PackWriter:
+    """Collects small files from many threads into packs. on_packed(changes,
+    uploaded) is called from whichever thread seals a pack once it has been
+    stored, with (row, released) for each file in it and whether the pack
+    had to be uploaded. If storing or recording the pack fails
+    on_failed(changes, error) is called instead, so each file in it can be
+    counted as failed. flush must be called once every file has been added.
+    packed, if given, turns on deduplication and maps the hashes of files
+    that are already packed to (pack hash, offset, length), see
+    packed_files
+    """
+
+    def __init__(self, content_store, on_packed, on_failed,
+                 pack_size=PACK_SIZE, packed=None):
+        self.content_store = content_store
+        self.on_packed = on_packed
+        self.on_failed = on_failed
+        self.pack_size = pack_size
+        self._packed = packed
+        self._data = bytearray()
+        self._members = []
+        # (offset, length) of each file in the current pack by hash
+        self._offsets = {}
+        self._lock = threading.Lock()
+
+    def add(self, path, row, released=None):
+        """Adds path to the current pack, where row is the CloudFiles row
+        to write for it and released is passed through to on_packed
+        """
+        with open(path, "rb") as infile:
+            data = infile.read()
+        # The file may have changed since it was hashed, the row has to
+        # match the bytes that are actually packed
+        file_hash = hashlib.md5(data).hexdigest()
+        if row["md5Hash"] != file_hash:
+            print(f"{path} changed while it was being uploaded")
+            row = {**row, "md5Hash": file_hash}
+        if self._packed is not None:
+            with self._lock:
+                found = self._packed.get(file_hash)
+            if found is not None and self._share(path, row, released, found):
+                return
+        sealed = None
+        with self._lock:
+            place = self._offsets.get(file_hash)
+            if place is None:
+                place = (len(self._data), len(data))
+                self._data += data
+                if self._packed is not None:
+                    self._offsets[file_hash] = place
+            self._members.append((row, released) + place)
+            if len(self._data) >= self.pack_size:
+                sealed = self._take()
+        if sealed:
+            self._store(*sealed)
+
+    def _share(self, path, row, released, found):
+        """Records row as the copy of a file in a stored pack, returning
+        False if the pack can't be referred to any more
+        """
+        pack_hash, offset, length = found
+
+        def gone(key):
+            raise ValueError(f"{key} is no longer stored")
+
+        try:
+            key, _ = self.content_store.upload(pack_hash, gone)
+        except ValueError:
+            return False
+        print(f"{path} is already packed in {key}")
+        self.on_packed(
+            [
+                (
+                    stored_item(
+                        row, "pack", size=length, packKey=key,
+                        packOffset=offset, packLength=length
+                    ),
+                    released
+                )
+            ],
+            False
+        )
+        return True
+
+    def flush(self):
+        with self._lock:
+            sealed = self._take()
+        if sealed[1]:
+            self._store(*sealed)
+
+    def _take(self):
+        sealed = (bytes(self._data), self._members)
+        self._data = bytearray()
+        self._members = []
+        self._offsets = {}
+        return sealed
+
+    def _store(self, data, members):
+        store = self.content_store
+        print(f"Uploading  pack of {len(members)} files ({len(data)} bytes)")
+        pack_hash = hashlib.md5(data).hexdigest()
+        try:
+            key, uploaded = store.upload(
+                pack_hash,
+                lambda key: store.s3_client.put_object(
+                    Bucket=store.bucket, Key=key, Body=data
+                ),
+                refs=len(members)
+            )
+            self.on_packed(
+                [
+                    (
+                        stored_item(
+                            row, "pack", size=length, packKey=key,
+                            packOffset=offset, packLength=length
+                        ),
+                        released
+                    )
+                    for row, released, offset, length in members
+                ],
+                uploaded
+            )
+        except Exception as e:
+            self.on_failed(
+                [(row, released) for row, released, _, _ in members], e
+            )
+            return
+        if self._packed is not None:
+            with self._lock:
+                for row, _, offset, length in members:
+                    self._packed.setdefault(
+                        row["md5Hash"], (pack_hash, offset, length)
+                    )
+
+
+def packed_files(manifest):
+    """Returns {file hash: (pack hash, offset, length)} for the packed files
+    in the manifest, to dedupe new files against
+    """
+    packed = {}
+    for item in (manifest or {}).values():
+        if storage_of(item) == "pack":
+            packed.setdefault(item["md5Hash"], (
+                content_hash(item), int(item["packOffset"]),
+                int(item["packLength"])
+            ))
+    return packed
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Parallel download engine used by restorefromcloud.py
+
+Many objects are downloaded at once and objects larger than RANGE_THRESHOLD
+are split into byte ranges fetched in parallel. Each object is written into
+a preallocated temporary file with positional writes and only moved into
+place once the MD5 of its contents, computed as the bytes arrive, matches
+the hash recorded when it was uploaded. Files uploaded in content defined
+chunks are reassembled the same way, one piece per chunk, and files stored
+by content are fetched from their shared object. Files packed together are
+fetched with a ranged GET each, or several at once from a single ranged GET
+of the part of the pack that covers them. Objects that were compressed on
+upload are decompressed as they stream in.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import os
+import threading
+import time
+from common.compression import CODEC_METADATA, decompress_chunks
+from chunking import chunk_key, load_chunk_list
+
+DEFAULT_JOBS = 8
+RANGE_THRESHOLD = 64 * 1024 * 1024
+RANGE_SIZE = 8 * 1024 * 1024
+# How many ranges of a single object may be held in memory waiting for an
+# earlier range before it can be hashed
+RANGE_WINDOW = 4
+STREAM_CHUNK = 1024 * 1024
+
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def preallocate(fd, size):
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fd, 0, size)
+    else:
+        os.ftruncate(fd, size)
+
+
+class OrderedHasher:
+    """Hashes the ranges of an object in order even though they may finish
+    downloading out of order. slots bounds how many ranges can be waiting
+    """
+
+    def __init__(self, window=RANGE_WINDOW):
+        self.hash_md5 = hashlib.md5()
+        self.slots = threading.Semaphore(window)
+        self.error = None
+        self._next = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def feed(self, index, data):
+        with self._lock:
+            self._pending[index] = data
+            while self._next in self._pending:
+                self.hash_md5.update(self._pending.pop(self._next))
+                self._next += 1
+                self.slots.release()
+
+    def fail(self, error):
+        self.error = error
+        self.slots.release()
+
+    def hexdigest(self):
+        return self.hash_md5.hexdigest()
+
+
+class RestoreEngine:
+    def __init__(self, s3_client, bucket, jobs=DEFAULT_JOBS):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.restored = 0
+        self.bytes_restored = 0
+        self.errors = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._in_flight = threading.Semaphore(jobs * 2)
+        self._objects = ThreadPoolExecutor(max_workers=jobs)
+        self._ranges = ThreadPoolExecutor(max_workers=jobs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, key, dest, size, expected_md5=None, chunk_list=None,
+               source=None, offset=None):
+        """Queues key to be restored to dest, blocking while too many
+        objects are already in flight. If chunk_list is given it's the key
+        of the chunk list to reassemble the file from, and if source is
+        given it's the object holding the file's contents instead of key,
+        starting at offset if the file is packed inside it
+        """
+        source = source or key
+        if chunk_list:
+            def download(fd):
+                return self._download_pieces(
+                    fd, self._chunk_pieces(chunk_list)
+                )
+        elif offset is not None:
+            def download(fd):
+                return self._download_slice(fd, source, offset, size)
+        else:
+            def download(fd):
+                return self._download_object(fd, source, size)
+        return self._submit(self._restore, key, dest, size, expected_md5,
+                            download)
+
+    def submit_pack(self, source, members):
+        """Queues the packed files in members, each (key, dest, offset, size,
+        expected_md5), to be restored from one ranged GET of source. The
+        future returns {key: whether it was restored}
+        """
+        return self._submit(self._restore_pack, source, members)
+
+    def _submit(self, func, *args):
+        self._in_flight.acquire()
+        future = self._objects.submit(func, *args)
+        future.add_done_callback(lambda _: self._in_flight.release())
+        return future
+
+    def close(self):
+        self._objects.shutdown(wait=True)
+        self._ranges.shutdown(wait=True)
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        return (
+            f"Restored {self.restored} files ({self.bytes_restored} bytes) "
+            f"in {elapsed:.2f}s, {self.restored / elapsed:.1f} files/s, "
+            f"{self.bytes_restored / elapsed:.0f} bytes/s, "
+            f"{self.errors} errors"
+        )
+
+    def _restore(self, key, dest, size, expected_md5, download):
+        dest = str(dest)
+        tmp = f"{dest}.part"
+        try:
+            os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+            print(f"Restoring {key}")
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                preallocate(fd, size)
+                digest = download(fd)
+            finally:
+                os.close(fd)
+            if expected_md5 and digest != expected_md5:
+                raise ValueError(
+                    f"hash mismatch, expected {expected_md5} got {digest}"
+                )
+            os.replace(tmp, dest)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            print(f"Failed to restore {key}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return False
+        with self._lock:
+            self.restored += 1
+            self.bytes_restored += size
+        return True
+
+    def _restore_pack(self, source, members):
+        start = min(offset for _, _, offset, _, _ in members)
+        end = max(offset + size for _, _, offset, size, _ in members)
+        try:
+            data = self._read_range(source, start, end - start)
+            error = None
+        except Exception as e:
+            data, error = None, e
+
+        def write_member(offset, size):
+            def download(fd):
+                if error is not None:
+                    raise error
+                piece = data[offset - start:offset - start + size]
+                pwrite_all(fd, piece, 0)
+                return hashlib.md5(piece).hexdigest()
+            return download
+
+        return {
+            key: self._restore(
+                key, dest, size, expected_md5, write_member(offset, size)
+            )
+            for key, dest, offset, size, expected_md5 in members
+        }
+
+    def _read_range(self, key, offset, length):
+        if length == 0:
+            return b""
+        end = offset + length - 1
+        data = self.s3_client.get_object(
+            Bucket=self.bucket, Key=key, Range=f"bytes={offset}-{end}"
+        )["Body"].read()
+        if len(data) != length:
+            raise IOError(f"short read of bytes {offset}-{end}")
+        return data
+
+    def _download_slice(self, fd, key, offset, size):
+        data = self._read_range(key, offset, size)
+        pwrite_all(fd, data, 0)
+        return hashlib.md5(data).hexdigest()
+
+    def _download_object(self, fd, key, size):
+        if size >= RANGE_THRESHOLD:
+            # A compressed object has to be decompressed from the start, so
+            # only split it into ranges if it wasn't compressed
+            head = self.s3_client.head_object(Bucket=self.bucket, Key=key)
+            if not head["Metadata"].get(CODEC_METADATA.lower()):
+                return self._download_pieces(
+                    fd, self._range_pieces(key, size)
+                )
+        return self._download_whole(fd, key)
+
+    def _download_whole(self, fd, key):
+        hash_md5 = hashlib.md5()
+        resp = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        chunks = resp["Body"].iter_chunks(STREAM_CHUNK)
+        codec = resp.get("Metadata", {}).get(CODEC_METADATA.lower())
+        if codec:
+            chunks = decompress_chunks(chunks, codec)
+        offset = 0
+        for chunk in chunks:
+            pwrite_all(fd, chunk, offset)
+            hash_md5.update(chunk)
+            offset += len(chunk)
+        os.ftruncate(fd, offset)
+        return hash_md5.hexdigest()
+
+    def _range_pieces(self, key, size):
+        """Yields (offset, fetch) for each RANGE_SIZE slice of key"""
+        def fetch_range(start, length):
+            return lambda: self._read_range(key, start, length)
+
+        for start in range(0, size, RANGE_SIZE):
+            yield start, fetch_range(start, min(RANGE_SIZE, size - start))
+
+    def _chunk_pieces(self, chunk_list):
+        """Yields (offset, fetch) for each chunk in a chunk list"""
+        def fetch_chunk(digest, length):
+            def fetch():
+                data = self.s3_client.get_object(
+                    Bucket=self.bucket, Key=chunk_key(digest)
+                )["Body"].read()
+                if (len(data) != length
+                        or hashlib.sha256(data).hexdigest() != digest):
+                    raise IOError(f"chunk {digest} is corrupt")
+                return data
+            return fetch
+
+        offset = 0
+        for digest, length in load_chunk_list(
+            self.s3_client, self.bucket, chunk_list
+        ):
+            yield offset, fetch_chunk(digest, length)
+            offset += length
+
+    def _download_pieces(self, fd, pieces):
+        """Fetches pieces of (offset, fetch) in parallel, writing each at its
+        offset, and returns the MD5 of the whole file
+        """
+        hasher = OrderedHasher()
+
+        def run(index, offset, fetch):
+            try:
+                data = fetch()
+                pwrite_all(fd, data, offset)
+                hasher.feed(index, data)
+            except Exception as e:
+                hasher.fail(e)
+
+        futures = []
+        for index, (offset, fetch) in enumerate(pieces):
+            hasher.slots.acquire()
+            if hasher.error:
+                break
+            futures.append(self._ranges.submit(run, index, offset, fetch))
+        for future in futures:
+            future.result()
+        if hasher.error:
+            raise hasher.error
+        return hasher.hexdigest()
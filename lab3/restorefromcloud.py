@@ -5,70 +5,245 @@ __copyright__ = "Copyright 2020"
 
 Simple script to download files and folders from S3 preserving the folder structure
 """
+import getopt
+import os
+import sys
 import boto3
-import hashlib
+from botocore.exceptions import BotoCoreError, ClientError
 from pprint import pprint
 from pathlib import Path
 
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from common.hashing import md5_hash
+from common.statcache import StatCache
+from cloudfiles import DYNAMO_URL, query_manifest, storage_of
+from chunking import CHUNK_PREFIX, CHUNK_LIST_PREFIX
+from contentstore import OBJECT_PREFIX
+from restoreengine import RestoreEngine, DEFAULT_JOBS
+from s3lister import iter_objects, iter_objects_sharded
+
 
 S3_ROOT_DIR="22487668-cloudstorage"
 
 BUCKET_CONFIG = {'LocationConstraint': 'ap-southeast-2'}
 RESTORE_PATH = "."
-
-
-def md5_hash(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as infile:
-        for chunk in iter(lambda: infile.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-
-def pull_files(s3_client, s3_resource, dynamo):
-    response = s3_client.list_objects(
-        Bucket=S3_ROOT_DIR,
-        Delimiter=","
+# Objects under these prefixes hold pieces of files rather than files
+INTERNAL_PREFIXES = (CHUNK_PREFIX, CHUNK_LIST_PREFIX, OBJECT_PREFIX)
+JOURNAL_NAME = ".restore-journal.sqlite"
+# Packed files are fetched with one GET covering all of them when they make
+# up at least this much of the range of the pack it would have to cover
+PACK_FETCH_RATIO = 0.5
+SHORT_ARGS = "hj:s"
+LONG_ARGS = ["help", "jobs=", "shard"]
+
+
+def fetch_manifest(dynamo):
+    """Returns the owner's CloudFiles rows keyed by path, or None if
+    DynamoDB can't be reached
+    """
+    try:
+        manifest = query_manifest(dynamo)
+    except (BotoCoreError, ClientError) as e:
+        print(f"Unable to fetch the manifest: {e}")
+        return None
+    print(f"Fetched {len(manifest)} entries from the manifest")
+    return manifest
+
+
+def has_internal_objects(s3_client):
+    """Returns True if any files in the bucket are stored as chunks, by
+    content or in packs, which only the manifest can say how to restore
+    """
+    return any(
+        next(iter_objects(s3_client, S3_ROOT_DIR, prefix), None)
+        for prefix in INTERNAL_PREFIXES
     )
 
-    try:
-        file_contents = response["Contents"]
-    except KeyError:
-        print("No files in the S3 bucket specified")
-        return
-    file_names = [file["Key"] for file in file_contents]
+
+def object_hash(s3_client, manifest, key):
+    """Returns the MD5 recorded for key, only asking S3 for the object's
+    metadata if it's missing from the manifest
+    """
+    item = manifest.get(key)
+    if item is not None:
+        return item["md5Hash"]
+    head = s3_client.head_object(Bucket=S3_ROOT_DIR, Key=key)
+    return head["Metadata"]["md5hash"]
+
+
+def local_hash(journal, key, file_path):
+    """Returns the hash of a file that already exists, trusting the journal
+    if the file hasn't changed since it was restored or last hashed
+    """
+    st = file_path.stat()
+    file_hash = journal.lookup(key, st)
+    if file_hash is None:
+        file_hash = md5_hash(str(file_path))
+        journal.store(key, st, file_hash)
+    return file_hash
+
+
+def journal_restore(journal, key, file_path, file_hash):
+    """Returns a callback recording key in the journal once its download
+    has completed successfully
+    """
+    def record(future):
+        if future.result():
+            journal.store(key, file_path.stat(), file_hash, verified=True)
+    return record
+
+
+def journal_pack_restore(journal, members):
+    """Returns a callback recording each member of a pack restored by
+    RestoreEngine.submit_pack in the journal
+    """
+    def record(future):
+        restored = future.result()
+        for key, file_path, _, _, file_hash in members:
+            if restored[key]:
+                journal.store(key, file_path.stat(), file_hash, verified=True)
+    return record
+
+
+def fetch_whole(members):
+    """Returns True if the packed files in members are worth fetching with a
+    single GET rather than one each
+    """
+    start = min(offset for _, _, offset, _, _ in members)
+    end = max(offset + size for _, _, offset, size, _ in members)
+    wanted = sum(size for _, _, _, size, _ in members)
+    return len(members) > 1 and wanted >= PACK_FETCH_RATIO * (end - start)
+
+
+def pull_files(s3_client, s3_resource, dynamo, jobs=DEFAULT_JOBS,
+               shard=False):
+    if shard:
+        objects = iter_objects_sharded(s3_client, S3_ROOT_DIR, jobs)
+    else:
+        objects = iter_objects(s3_client, S3_ROOT_DIR)
+    manifest = fetch_manifest(dynamo)
+    if manifest is None:
+        if has_internal_objects(s3_client):
+            print(
+                "Not restoring, files stored as chunks, by content or in "
+                "packs can't be found without the manifest"
+            )
+            return
+        print("Falling back to HEAD for each object")
+        manifest = {}
     restore_dir = Path(RESTORE_PATH).absolute()
-    for file in file_names:
-        s3_obj = s3_resource.Object(S3_ROOT_DIR, file)
-        cloud_hash = s3_obj.metadata["md5hash"]
-        file_path = restore_dir / file
+    listed = 0
+    journal = StatCache(str(restore_dir), name=JOURNAL_NAME)
+    packs = {}
+
+    def unchanged(file, file_path, cloud_hash):
         if file_path.exists():
-            if cloud_hash == md5_hash(str(file_path)):
+            if cloud_hash == local_hash(journal, file, file_path):
                 print(
                     f"Skipping {file_path}, it is unchanged"
                 )
-                continue
-        if not file_path.parent.exists():
-            file_path.parent.mkdir(parents=True, exist_ok=True)
+                return True
+        return False
 
-        print(
-            f"Restoring {file}"
-        )
-        response = s3_resource.meta.client.download_file(
-            Bucket=S3_ROOT_DIR,
-            Key=file,
-            Filename=str(file_path)
+    def restore(file, size, cloud_hash, **kwargs):
+        file_path = restore_dir / file
+        if unchanged(file, file_path, cloud_hash):
+            return
+        future = engine.submit(file, file_path, size, cloud_hash, **kwargs)
+        future.add_done_callback(
+            journal_restore(journal, file, file_path, cloud_hash)
         )
 
+    with journal, RestoreEngine(s3_client, S3_ROOT_DIR, jobs) as engine:
+        for obj in objects:
+            file = obj["Key"]
+            item = manifest.get(file)
+            if item is None:
+                # Chunks, chunk lists and stored contents have no row, but
+                # a file that happens to be under one of their prefixes does
+                if file.startswith(INTERNAL_PREFIXES):
+                    continue
+            elif storage_of(item) != "path":
+                # A stale object left behind after the file was re-stored
+                continue
+            listed += 1
+            restore(file, obj["Size"], object_hash(s3_client, manifest, file))
+
+        # Files stored as chunks, by content or in packs have no object of
+        # their own to list
+        for file, item in manifest.items():
+            if storage_of(item) == "chunks":
+                listed += 1
+                restore(
+                    file, int(item["size"]), item["md5Hash"],
+                    chunk_list=item["chunkList"]
+                )
+            elif storage_of(item) == "cas":
+                listed += 1
+                restore(
+                    file, int(item["size"]), item["md5Hash"],
+                    source=item["contentKey"]
+                )
+            elif storage_of(item) == "pack":
+                listed += 1
+                file_path = restore_dir / file
+                if not unchanged(file, file_path, item["md5Hash"]):
+                    packs.setdefault(item["packKey"], []).append((
+                        file, file_path, int(item["packOffset"]),
+                        int(item["packLength"]), item["md5Hash"]
+                    ))
+
+        for pack_key, members in packs.items():
+            if fetch_whole(members):
+                future = engine.submit_pack(pack_key, members)
+                future.add_done_callback(
+                    journal_pack_restore(journal, members)
+                )
+                continue
+            for file, file_path, offset, size, file_hash in members:
+                future = engine.submit(
+                    file, file_path, size, file_hash, source=pack_key,
+                    offset=offset
+                )
+                future.add_done_callback(
+                    journal_restore(journal, file, file_path, file_hash)
+                )
+    if not listed:
+        print("No files in the S3 bucket specified")
+        return
+    print(engine.summary())
+
+
+def print_help():
+    print(
+        f"Usage restorefromcloud.py [OPTION]\n"
+        f"Downloads the files in an S3 bucket to the current directory\n"
+        f"-j, --jobs N\tNumber of concurrent downloads "
+        f"(default {DEFAULT_JOBS})\n"
+        f"-s, --shard\tList each top level prefix of the bucket in "
+        f"parallel\n"
+        f"-h, --help\tDisplay this help menu then quit\n"
+    )
+
 
 def main():
+    opts = getopt.getopt(sys.argv[1:], SHORT_ARGS, LONG_ARGS)[0]
+    jobs = DEFAULT_JOBS
+    shard = False
+    for opt in opts:
+        if opt[0] == '-j' or opt[0] == '--jobs':
+            jobs = max(1, int(opt[1]))
+        elif opt[0] == '-s' or opt[0] == '--shard':
+            shard = True
+        elif opt[0] == '-h' or opt[0] == '--help':
+            print_help()
+            return
     s3_client = boto3.client("s3")
     s3_resource = boto3.resource("s3")
-    dynamo = boto3.resource("dynamodb", endpoint_url="http://localhost:8000")
-    pull_files(s3_client, s3_resource, dynamo)
-
-
-
+    dynamo = boto3.resource("dynamodb", endpoint_url=DYNAMO_URL)
+    pull_files(s3_client, s3_resource, dynamo, jobs, shard)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Streaming listing of the objects in an S3 bucket
+
+Objects are yielded page by page as list_objects_v2 returns them, so a
+consumer can start working on the first keys straight away and memory use
+doesn't grow with the size of the bucket. iter_objects_sharded lists each
+top level prefix on its own thread to enumerate large buckets faster.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+
+DEFAULT_LISTERS = 4
+QUEUE_SIZE = 10000
+
+_DONE = object()
+
+
+def iter_objects(s3_client, bucket, prefix=""):
+    """Yields the object summaries (Key, Size, ETag...) under prefix"""
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
+def top_level_prefixes(s3_client, bucket, delimiter="/"):
+    """Returns the objects at the top level of the bucket and the common
+    prefixes below it
+    """
+    objects = []
+    prefixes = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Delimiter=delimiter):
+        objects.extend(page.get("Contents", []))
+        prefixes.extend(
+            prefix["Prefix"] for prefix in page.get("CommonPrefixes", [])
+        )
+    return objects, prefixes
+
+
+def iter_objects_sharded(s3_client, bucket, listers=DEFAULT_LISTERS,
+                         delimiter="/"):
+    """Yields every object in the bucket, listing the top level prefixes
+    in parallel. Keys from different prefixes are interleaved
+    """
+    objects, prefixes = top_level_prefixes(s3_client, bucket, delimiter)
+    yield from objects
+    if not prefixes:
+        return
+
+    results = queue.Queue(maxsize=QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up if the consumer has gone away rather than blocking forever
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def list_prefix(prefix):
+        try:
+            for obj in iter_objects(s3_client, bucket, prefix):
+                if not put(obj):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    pool = ThreadPoolExecutor(max_workers=listers)
+    try:
+        for prefix in prefixes:
+            pool.submit(list_prefix, prefix)
+        remaining = len(prefixes)
+        while remaining:
+            item = results.get()
+            if item is _DONE:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        stop.set()
+        pool.shutdown(wait=True)
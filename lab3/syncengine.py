@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Pipelined sync engine used by cloudstorage.py
+
+Files flow through a chain of stages (hash -> check -> upload ...), each
+served by its own pool of worker threads. Stages are connected by bounded
+queues, so a slow stage applies back pressure to the ones before it and
+memory use stays flat no matter how large the tree being synced is.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+import queue
+import threading
+import time
+
+DEFAULT_QUEUE_SIZE = 1000
+FLUSH_INTERVAL = 0.5
+
+# Marks the end of the stream on a stage's input queue
+_DONE = object()
+
+
+class Stage:
+    """A single step of the pipeline
+
+    func is called with one item at a time and returns the item to pass
+    downstream, or None to drop it. If batch_size is set func is instead
+    called with a list of up to batch_size items and returns an iterable
+    of items to pass downstream. Partial batches are flushed whenever the
+    input queue has been idle for FLUSH_INTERVAL seconds.
+    """
+
+    def __init__(self, name, func, workers=1, batch_size=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.in_queue = None
+        self.next = None
+        self._running = workers
+        self._lock = threading.Lock()
+
+    def worker_finished(self):
+        """Returns True if the calling worker was the last one running"""
+        with self._lock:
+            self._running -= 1
+            return self._running == 0
+
+
+class SyncStats:
+    """Thread safe counters used to report throughput once a sync is done"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.files_scanned = 0
+        self.bytes_scanned = 0
+        self.files_uploaded = 0
+        self.bytes_uploaded = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def scanned(self, size):
+        with self._lock:
+            self.files_scanned += 1
+            self.bytes_scanned += size
+
+    def uploaded(self, size):
+        with self._lock:
+            self.files_uploaded += 1
+            self.bytes_uploaded += size
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return (
+            f"Scanned {self.files_scanned} files "
+            f"({self.bytes_scanned} bytes), "
+            f"uploaded {self.files_uploaded} files "
+            f"({self.bytes_uploaded} bytes) in {elapsed:.2f}s\n"
+            f"{self.files_scanned / elapsed:.1f} files/s scanned, "
+            f"{self.files_uploaded / elapsed:.1f} files/s and "
+            f"{self.bytes_uploaded / elapsed:.0f} bytes/s uploaded, "
+            f"{self.errors} errors"
+        )
+
+
+class Pipeline:
+    """Runs items from a source iterable through a chain of stages"""
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, stats=None):
+        self.queue_size = queue_size
+        self.stats = stats if stats is not None else SyncStats()
+        self.stages = []
+
+    def add_stage(self, name, func, workers=1, batch_size=None):
+        self.stages.append(Stage(name, func, workers, batch_size))
+        return self
+
+    def run(self, source):
+        """Feeds every item of source through the pipeline, blocking until
+        all stages have drained
+        """
+        if not self.stages:
+            return
+        for stage in self.stages:
+            stage.in_queue = queue.Queue(maxsize=self.queue_size)
+            stage._running = stage.workers
+        for stage, next_stage in zip(self.stages, self.stages[1:]):
+            stage.next = next_stage
+        self.stages[-1].next = None
+
+        threads = []
+        for stage in self.stages:
+            for i in range(stage.workers):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(stage,),
+                    name=f"{stage.name}-{i}",
+                    daemon=True
+                )
+                thread.start()
+                threads.append(thread)
+
+        first = self.stages[0]
+        try:
+            for item in source:
+                first.in_queue.put(item)
+        finally:
+            for _ in range(first.workers):
+                first.in_queue.put(_DONE)
+            for thread in threads:
+                thread.join()
+
+    def _emit(self, stage, results):
+        if stage.next is None:
+            return
+        for result in results:
+            if result is not None:
+                stage.next.in_queue.put(result)
+
+    def _call(self, stage, payload):
+        try:
+            if stage.batch_size:
+                return stage.func(payload) or ()
+            return (stage.func(payload),)
+        except Exception as e:
+            self.stats.error()
+            print(f"{stage.name} failed for {payload}: {e}")
+            return ()
+
+    def _work(self, stage):
+        batch = []
+        while True:
+            timeout = FLUSH_INTERVAL if batch else None
+            try:
+                item = stage.in_queue.get(timeout=timeout)
+            except queue.Empty:
+                self._emit(stage, self._call(stage, batch))
+                batch = []
+                continue
+            if item is _DONE:
+                break
+            if not stage.batch_size:
+                self._emit(stage, self._call(stage, item))
+                continue
+            batch.append(item)
+            if len(batch) >= stage.batch_size:
+                self._emit(stage, self._call(stage, batch))
+                batch = []
+
+        if batch:
+            self._emit(stage, self._call(stage, batch))
+        if stage.worker_finished() and stage.next is not None:
+            for _ in range(stage.next.workers):
+                stage.next.in_queue.put(_DONE)
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+Watches a directory tree for changes so cloudstorage.py can sync continuously
+
+On Linux every directory in the tree is watched with inotify through ctypes,
+anywhere else, or if inotify runs out of watches, the tree is polled and
+compared against the previous snapshot instead. Either way changes are
+reported as paths relative to the root in the same form the scanner yields
+them, and debounced coalesces a burst of changes into a single batch once
+the tree has been quiet for a moment.
+
+Some changes can't be described by a list of files, like a directory being
+deleted or inotify's event queue overflowing, so those are reported as
+RESCAN and the whole tree should be synced again.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from common.scanner import scan
+
+# Wait for the tree to have been quiet this long before syncing a batch, but
+# never hold a change back for more than MAX_DELAY seconds
+DEBOUNCE = 1.0
+MAX_DELAY = 10.0
+POLL_INTERVAL = 2.0
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+    | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+EVENT = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+# Marks that the whole tree has to be synced again
+RESCAN = object()
+
+
+def relative_path(dir_path, name):
+    return f"{dir_path}/{name}" if dir_path else name
+
+
+def iter_tree(root, dir_path=""):
+    """Yields (relative path, DirEntry) for every file and directory below
+    dir_path
+    """
+    try:
+        entries = list(os.scandir(os.path.join(root, dir_path)))
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for entry in entries:
+        path = relative_path(dir_path, entry.name)
+        yield path, entry
+        if entry.is_dir(follow_symlinks=False):
+            yield from iter_tree(root, path)
+
+
+class InotifyWatcher:
+    """Watches every directory below root with inotify, raising OSError if
+    that isn't possible
+    """
+
+    def __init__(self, root):
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self.root = root
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library("c") or "libc.so.6", use_errno=True
+        )
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._dirs = {}
+        try:
+            self._watch_tree("")
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _watch(self, dir_path):
+        wd = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(os.path.join(self.root, dir_path)),
+            WATCH_MASK
+        )
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dir_path)
+        self._dirs[wd] = dir_path
+
+    def _watch_tree(self, dir_path):
+        """Watches dir_path and every directory below it, returning the files
+        already in them since they were created before the watches were
+        """
+        self._watch(dir_path)
+        files = []
+        for path, entry in iter_tree(self.root, dir_path):
+            if entry.is_dir(follow_symlinks=False):
+                try:
+                    self._watch(path)
+                except FileNotFoundError:
+                    continue
+            else:
+                files.append(path)
+        return files
+
+    def read(self, timeout):
+        """Waits up to timeout seconds for changes and returns the paths
+        that changed, which may include RESCAN, or None if nothing happened.
+        The list can be empty if all that happened was a directory being
+        created
+        """
+        ready = select.select([self._fd], [], [], timeout)[0]
+        if not ready:
+            return None
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return None
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            changed.extend(self._event(wd, mask, name))
+        return changed
+
+    def _event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            return [RESCAN]
+        dir_path = self._dirs.get(wd)
+        if dir_path is None:
+            return []
+        if mask & IN_IGNORED:
+            del self._dirs[wd]
+            return []
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            # Whatever was inside has gone with it
+            return [RESCAN] if dir_path else []
+        path = relative_path(dir_path, name)
+        if not mask & IN_ISDIR:
+            return [path]
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            try:
+                return self._watch_tree(path)
+            except FileNotFoundError:
+                return []
+        if mask & IN_MOVED_FROM:
+            return [RESCAN]
+        return []
+
+
+class PollingWatcher:
+    """Finds changes by comparing snapshots of the tree's sizes and
+    modification times taken every interval seconds
+    """
+
+    def __init__(self, root, interval=POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._next = time.monotonic() + interval
+
+    def close(self):
+        pass
+
+    def _scan(self):
+        return {
+            path: (st.st_size, st.st_mtime_ns)
+            for path, _, st in scan(self.root)
+        }
+
+    def read(self, timeout):
+        wait = self._next - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return None
+        time.sleep(max(wait, 0))
+        self._next = time.monotonic() + self.interval
+        old, new = self._snapshot, self._scan()
+        self._snapshot = new
+        changed = [
+            path for path in old.keys() | new.keys()
+            if old.get(path) != new.get(path)
+        ]
+        return changed or None
+
+
+def open_watcher(root):
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError) as e:
+        print(f"inotify is unavailable ({e}), polling for changes instead")
+        return PollingWatcher(root)
+
+
+def debounced(watcher, quiet=DEBOUNCE, max_delay=MAX_DELAY):
+    """Yields (paths, rescan) for each burst of changes seen by watcher,
+    once it has been quiet for quiet seconds or max_delay seconds after the
+    first change. Files directly in the root are left out, as they are by
+    the scanner
+    """
+    while True:
+        paths = set()
+        rescan = False
+        first = None
+        while True:
+            if first is None:
+                timeout = max_delay
+            else:
+                timeout = min(quiet, first + max_delay - time.monotonic())
+                if timeout <= 0:
+                    break
+            changed = watcher.read(timeout)
+            if changed is None:
+                if first is None:
+                    continue
+                break
+            for path in changed:
+                if path is RESCAN:
+                    rescan = True
+                elif "/" in path:
+                    paths.add(path)
+            if first is None and (paths or rescan):
+                first = time.monotonic()
+        yield paths, rescan
@@ -3,7 +3,9 @@
 Simple script for traversing a directory's file tree and uploading all files
 to S3 preserving the structure using S3 filenames
 
-Encrypted client side using AES-256
+Encrypted client side using AES-256 in GCM mode, see encformat.py for the
+format of the uploaded objects. Files that compress well can be compressed
+before they're encrypted, since ciphertext doesn't compress
 
 Borrows some code from David Glance's example code here:
 
@@ -22,40 +24,115 @@ import sys
 import hashlib
 import boto3
 from Crypto.Cipher import AES
-from Crypto import Random
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from common.compression import (
+    CODEC_METADATA, DecompressingWriter, compress_file, file_codec
+)
+from common.hashing import hash_files
+from common.multipart import upload_stream
+from common.scanner import PathFilter, DEFAULT_EXCLUDES, scan
+from common.statcache import StatCache
+from datakeys import DataKeyCache
+from kmskeys import caller_account, resolve_alias
+import encformat
+import parallelenc
 
 ROOT_DIR = '.'
 ROOT_S3_DIR = '22487668-enc'
-SHORT_ARGS = "ih"
-LONG_ARGS = ["initialise", "help"]
+SHORT_ARGS = "ihre:w:zx:I:"
+LONG_ARGS = [
+    "initialise", "help", "rehash", "encrypt=", "workers=", "compress",
+    "exclude=", "include="
+]
 BLOCK_SIZE = 64 * 1024
-CHUNK_SIZE = 16
+PARALLEL_THRESHOLD = 8 * 1024 * 1024
+# Smaller files are encrypted together across the pool in batches of up to
+# BATCH_FILES files
+BATCH_FILES = 256
 password = "kitty and the kat"
 
 bucket_config = {'LocationConstraint': 'ap-southeast-2'}
 
 
-def md5_hash(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as infile:
-        for chunk in iter(lambda: infile.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+def password_key():
+    return hashlib.sha256(password.encode("utf-8")).digest()
 
 
-def upload_file(s3_resource, path, file_hash, modtime):
-    print(f"Uploading  { path }")
+def encryption_key(path, file_hash, modtime, data_keys=None):
+    """Returns (key, extra_args) to encrypt and upload path with"""
     metadata = {
         "Metadata": {
             "ModificationTime": modtime,
             "Md5Hash": file_hash
         }
     }
-    s3_resource.meta.client.upload_file(
-        Filename=path,
-        Bucket=ROOT_S3_DIR,
-        Key=path,
-        ExtraArgs=metadata
+    if data_keys:
+        key, wrapped = data_keys.encryption_key(os.path.getsize(path))
+        metadata["Metadata"]["WrappedKey"] = (
+            base64.b64encode(wrapped).decode("ascii")
+        )
+    else:
+        key = password_key()
+    return key, metadata
+
+
+def upload_batch(s3_client, batch, pool, data_keys=None):
+    """Encrypts the (path, file_hash, modtime) in batch across the process
+    pool, several files at once, and uploads each as path.enc as soon as
+    it's ready, straight from the shared memory the pool encrypted it into
+    """
+    jobs = []
+    metadatas = []
+    for path, file_hash, modtime in batch:
+        key, metadata = encryption_key(path, file_hash, modtime, data_keys)
+        jobs.append((key, path))
+        metadatas.append(metadata)
+    encrypted = parallelenc.encrypt_small_files(jobs, pool)
+    for (path, _, _), metadata, chunks in zip(batch, metadatas, encrypted):
+        print(f"Uploading  { path }.enc")
+        upload_stream(
+            s3_client,
+            ROOT_S3_DIR,
+            f"{path}.enc",
+            chunks,
+            extra_args=metadata
+        )
+
+
+def upload_encrypted(s3_client, path, file_hash, modtime, data_keys=None,
+                     pool=None, compress=False):
+    """Encrypts path and streams the result straight to S3 as path.enc
+
+    If data_keys is given the file is encrypted with a KMS data key from
+    it and the wrapped data key is stored in the object's metadata,
+    otherwise the key is derived from the password. Files of at least
+    PARALLEL_THRESHOLD bytes are encrypted across the process pool if one
+    is given, main batches smaller ones with upload_batch instead. With
+    compress, files that compress well are compressed before being
+    encrypted, which is always done in this process since the pool works
+    on the file itself
+    """
+    print(f"Uploading  { path }.enc")
+    key, metadata = encryption_key(path, file_hash, modtime, data_keys)
+    codec = file_codec(path) if compress else None
+    if codec:
+        metadata["Metadata"][CODEC_METADATA] = codec
+        chunks = encformat.encrypt_chunks(
+            key, compress_file(path, codec), BLOCK_SIZE
+        )
+    elif pool is not None and os.path.getsize(path) >= PARALLEL_THRESHOLD:
+        chunks = parallelenc.encrypt_stream(key, path, pool)
+    else:
+        chunks = encrypt_stream(key, path)
+    upload_stream(
+        s3_client,
+        ROOT_S3_DIR,
+        f"{path}.enc",
+        chunks,
+        extra_args=metadata
     )
 
 
@@ -64,6 +141,17 @@ def print_help():
         "Usage cloudstorage.py [OPTION]\n"
         "Uploads the files in a given directory to S3\n"
         "-i, --initialise\tCreate a new S3 bucket\n"
+        "-r, --rehash\tHash every file even if the stat cache says it's "
+        "unchanged\n"
+        "-e, --encrypt ALIAS\tEncrypt with data keys from the KMS key ALIAS "
+        "instead of the password\n"
+        "-w, --workers N\tEncrypt across N processes, several small "
+        "files at once or large files in pieces (default 1)\n"
+        "-z, --compress\tCompress files that compress well before "
+        "encrypting them\n"
+        f"-x, --exclude GLOB\tSkip files and directories matching GLOB, "
+        f"as well as {', '.join(DEFAULT_EXCLUDES)}\n"
+        "-I, --include GLOB\tOnly upload files matching GLOB\n"
         "-h, --help\tDisplay this help menu then quit\n"
     )
 
@@ -84,27 +172,43 @@ def create_bucket(s3_client):
         return False
 
 
+def encrypt_stream(key, in_filename):
+    """Yields the encrypted contents of in_filename in the segmented AES-GCM
+    format from encformat.py, header first, one segment at a time
+    """
+    with open(in_filename, 'rb') as infile:
+        yield from encformat.encrypt_stream(key, infile, BLOCK_SIZE)
+
+
 def encrypt_file(password, in_filename, out_filename):
 
     key = hashlib.sha256(password.encode("utf-8")).digest()
 
-    iv = Random.new().read(AES.block_size)
-    encryptor = AES.new(key, AES.MODE_CBC, iv)
-    filesize = os.path.getsize(in_filename)
+    with open(out_filename, 'wb') as outfile:
+        for chunk in encrypt_stream(key, in_filename):
+            outfile.write(chunk)
 
-    with open(in_filename, 'rb') as infile:
-        with open(out_filename, 'wb') as outfile:
-            outfile.write(struct.pack('<Q', filesize))
-            outfile.write(iv)
 
-            while True:
-                chunk = infile.read(CHUNK_SIZE)
-                if len(chunk) == 0:
-                    break
-                elif len(chunk) % 16 != 0:
-                    chunk += ' '.encode("utf-8") * (16 - len(chunk) % 16)
+def decrypt_stream(key, infile, outfile):
+    """Decrypts the readable infile into the seekable outfile, accepting
+    both the segmented format and the original CBC one
+    """
+    prefix = infile.read(struct.calcsize('Q'))
+    if encformat.is_segmented(prefix):
+        encformat.decrypt_stream(key, infile, outfile, prefix)
+        return
+
+    origsize = struct.unpack('<Q', prefix)[0]
+    iv = infile.read(16)
+    decryptor = AES.new(key, AES.MODE_CBC, iv)
 
-                outfile.write(encryptor.encrypt(chunk))
+    while True:
+        chunk = infile.read(BLOCK_SIZE)
+        if len(chunk) == 0:
+            break
+        outfile.write(decryptor.decrypt(chunk))
+
+    outfile.truncate(origsize)
 
 
 def decrypt_file(password, in_filename, out_filename):
@@ -112,51 +216,147 @@ def decrypt_file(password, in_filename, out_filename):
     key = hashlib.sha256(password.encode("utf-8")).digest()
 
     with open(in_filename, 'rb') as infile:
-        origsize = struct.unpack('<Q', infile.read(struct.calcsize('Q')))[0]
-        iv = infile.read(16)
-        decryptor = AES.new(key, AES.MODE_CBC, iv)
-
         with open(out_filename, 'wb') as outfile:
-            while True:
-                chunk = infile.read(CHUNK_SIZE)
-                if len(chunk) == 0:
-                    break
-                outfile.write(decryptor.decrypt(chunk))
+            decrypt_stream(key, infile, outfile)
+
+
+def object_key(resp, key_name, data_keys):
+    """Returns the AES key for an object given its GET response"""
+    wrapped = resp["Metadata"].get("wrappedkey")
+    if not wrapped:
+        return password_key()
+    if data_keys is None:
+        raise ValueError(f"{key_name} needs a KMS key to decrypt")
+    return data_keys.decryption_key(base64.b64decode(wrapped))
+
+
+def download_decrypted(s3_client, key_name, out_filename, data_keys=None):
+    """Downloads and decrypts the object key_name into out_filename,
+    unwrapping its data key through data_keys if it was envelope encrypted
+    and decompressing it if it was compressed
+    """
+    resp = s3_client.get_object(Bucket=ROOT_S3_DIR, Key=key_name)
+    key = object_key(resp, key_name, data_keys)
+    codec = resp["Metadata"].get(CODEC_METADATA.lower())
+    with open(out_filename, 'wb') as outfile:
+        if not codec:
+            decrypt_stream(key, resp["Body"], outfile)
+            return
+        writer = DecompressingWriter(outfile, codec)
+        decrypt_stream(key, resp["Body"], writer)
+        writer.close()
+
 
-            outfile.truncate(origsize)
+def download_range(s3_client, key_name, start, end, data_keys=None):
+    """Returns plaintext bytes start-end (inclusive) of the segmented object
+    key_name, fetching only the segments that hold them
+    """
+    head = s3_client.get_object(
+        Bucket=ROOT_S3_DIR,
+        Key=key_name,
+        Range=f"bytes=0-{encformat.HEADER.size - 1}"
+    )
+    header = head["Body"].read()
+    object_size = int(head["ContentRange"].rsplit("/", 1)[1])
+    if head["Metadata"].get(CODEC_METADATA.lower()):
+        raise ValueError(f"{key_name} is compressed so can't be read by range")
+    key = object_key(head, key_name, data_keys)
+
+    def read_at(offset, length):
+        if offset == 0 and length <= len(header):
+            return header[:length]
+        return s3_client.get_object(
+            Bucket=ROOT_S3_DIR,
+            Key=key_name,
+            Range=f"bytes={offset}-{offset + length - 1}"
+        )["Body"].read()
+
+    return encformat.decrypt_range(key, read_at, object_size, start, end)
 
 
 def main():
     opts = getopt.getopt(sys.argv[1:], SHORT_ARGS, LONG_ARGS)[0]
     initialise = False
+    rehash = False
+    enc_key_alias = ""
+    data_keys = None
+    workers = 1
+    pool = None
+    compress = False
+    includes = []
+    excludes = list(DEFAULT_EXCLUDES)
     s3_client = boto3.client("s3")
-    s3_resource = boto3.resource("s3")
     for opt in opts:
         if opt[0] == '-i' or opt[0] == '--initalise':
             initialise = True
         elif opt[0] == '-h' or opt[0] == '--help':
             print_help()
             return
+        elif opt[0] == '-r' or opt[0] == '--rehash':
+            rehash = True
         elif opt[0] == '-e' or opt[0] == '--encrypt':
             enc_key_alias = opt[1]
+        elif opt[0] == '-w' or opt[0] == '--workers':
+            workers = max(1, int(opt[1]))
+        elif opt[0] == '-z' or opt[0] == '--compress':
+            compress = True
+        elif opt[0] == '-x' or opt[0] == '--exclude':
+            excludes.append(opt[1])
+        elif opt[0] == '-I' or opt[0] == '--include':
+            includes.append(opt[1])
 
     if initialise:
         if not create_bucket(s3_client):
             return
 
+    # Envelope encrypt with data keys from KMS if a key was given
+    if enc_key_alias:
+        kms = boto3.client("kms")
+        account = caller_account(kms)
+        key_id = resolve_alias(kms, enc_key_alias, account=account)
+        if not key_id:
+            print(f"Can't find a key id for the alias {enc_key_alias}")
+            return
+        data_keys = DataKeyCache(
+            kms, key_id,
+            refresh_key_id=lambda: resolve_alias(
+                kms, enc_key_alias, account=account, refresh=True
+            )
+        )
+
+    if workers > 1:
+        pool = parallelenc.process_pool(workers)
+
     # parse directory and upload files
 
-    for dir_name, subdir, file_list in os.walk(ROOT_DIR, topdown=True):
-        if dir_name != ROOT_DIR:
-            for fname in file_list:
-                path = f"{dir_name[2:]}/{fname}"
-                print(path + '\n')
-                modtime = datetime.fromtimestamp(
-                    os.stat(path).st_mtime
-                ).strftime("%c")
-                file_hash = md5_hash(path)
-                encrypt_file(password, path, f"{path}.enc")
-                upload_file(s3_resource, f"{path}.enc", file_hash, modtime)
+    with StatCache(ROOT_DIR, rehash=rehash) as cache:
+        batch = []
+        # Files are hashed a few at a time on threads ahead of the uploads,
+        # going through the cache so unchanged files aren't read
+        entries = hash_files(
+            scan(ROOT_DIR, PathFilter(includes, excludes)),
+            hash_func=lambda entry: cache.hash(entry[0], entry[2])
+        )
+        for (path, fname, st), file_hash in entries:
+            print(path + '\n')
+            modtime = datetime.fromtimestamp(st.st_mtime).strftime("%c")
+            if (
+                pool is None or st.st_size >= PARALLEL_THRESHOLD
+                or (compress and file_codec(path))
+            ):
+                upload_encrypted(
+                    s3_client, path, file_hash, modtime, data_keys, pool,
+                    compress
+                )
+                continue
+            batch.append((path, file_hash, modtime))
+            if len(batch) >= BATCH_FILES:
+                upload_batch(s3_client, batch, pool, data_keys)
+                batch = []
+        if batch:
+            upload_batch(s3_client, batch, pool, data_keys)
+    if pool is not None:
+        pool.shutdown()
     print("done")
 
 
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Cached KMS data keys for envelope encryption
+
+Rather than asking KMS for a new data key per file, a key from
+GenerateDataKey is reused for many files until it is MAX_AGE seconds old,
+has encrypted MAX_MESSAGES files or MAX_BYTES bytes, in the same way as the
+AWS Encryption SDK's caching cryptographic materials manager. The wrapped
+copy of the key is stored with each object and unwrapped keys are kept in a
+small expiring LRU so decrypting a batch of objects costs one KMS Decrypt
+per data key rather than per object.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from collections import OrderedDict
+import threading
+import time
+from kmskeys import is_key_not_found
+
+MAX_AGE = 5 * 60
+MAX_MESSAGES = 1000
+MAX_BYTES = 2 ** 32
+MAX_ENTRIES = 64
+
+
+class DataKey:
+    def __init__(self, plaintext, wrapped):
+        self.plaintext = plaintext
+        self.wrapped = wrapped
+        self.created = time.monotonic()
+        self.messages = 0
+        self.bytes = 0
+
+    def age(self):
+        return time.monotonic() - self.created
+
+
+class DataKeyCache:
+    """refresh_key_id, if given, is called to look the key id up again if
+    KMS says key_id doesn't exist, like when it came from a stale cache
+    """
+
+    def __init__(self, kms, key_id, max_age=MAX_AGE,
+                 max_messages=MAX_MESSAGES, max_bytes=MAX_BYTES,
+                 max_entries=MAX_ENTRIES, refresh_key_id=None):
+        self.kms = kms
+        self.key_id = key_id
+        self.refresh_key_id = refresh_key_id
+        self.max_age = max_age
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._current = None
+        self._unwrapped = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _usable(self, data_key, size):
+        return (
+            data_key is not None
+            and data_key.age() < self.max_age
+            and data_key.messages < self.max_messages
+            and data_key.bytes + size <= self.max_bytes
+        )
+
+    def _remember(self, data_key):
+        self._unwrapped[data_key.wrapped] = data_key
+        self._unwrapped.move_to_end(data_key.wrapped)
+        while len(self._unwrapped) > self.max_entries:
+            self._unwrapped.popitem(last=False)
+
+    def encryption_key(self, size):
+        """Returns (plaintext, wrapped) data key to encrypt size bytes with,
+        generating a new one if the current key has been used up
+        """
+        with self._lock:
+            if not self._usable(self._current, size):
+                resp = self._generate()
+                self._current = DataKey(
+                    resp["Plaintext"], resp["CiphertextBlob"]
+                )
+                self._remember(self._current)
+            self._current.messages += 1
+            self._current.bytes += size
+            return self._current.plaintext, self._current.wrapped
+
+    def _generate(self):
+        try:
+            return self.kms.generate_data_key(
+                KeyId=self.key_id, KeySpec="AES_256"
+            )
+        except Exception as e:
+            if self.refresh_key_id is None or not is_key_not_found(e):
+                raise
+            key_id = self.refresh_key_id()
+            if not key_id or key_id == self.key_id:
+                raise
+            self.key_id = key_id
+        return self.kms.generate_data_key(
+            KeyId=self.key_id, KeySpec="AES_256"
+        )
+
+    def decryption_key(self, wrapped):
+        """Returns the plaintext of a wrapped data key, only calling KMS if
+        it isn't in the cache
+        """
+        with self._lock:
+            data_key = self._unwrapped.get(wrapped)
+            if data_key is not None and data_key.age() < self.max_age:
+                self._unwrapped.move_to_end(wrapped)
+                return data_key.plaintext
+        plaintext = self.kms.decrypt(CiphertextBlob=wrapped)["Plaintext"]
+        with self._lock:
+            self._remember(DataKey(plaintext, wrapped))
+        return plaintext
@@ -12,34 +12,51 @@ from datetime import datetime
 import os
 import getopt
 import sys
-import hashlib
 import boto3
 
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from common.compression import CODEC_METADATA, compress_file, file_codec
+from common.hashing import hash_files
+from common.multipart import upload_stream
+from common.scanner import PathFilter, DEFAULT_EXCLUDES, scan
+from common.statcache import StatCache
+from kmskeys import is_key_not_found, resolve_alias
+
 ROOT_DIR = '.'
 ROOT_S3_DIR = '22487668-enc'
-SHORT_ARGS = "ihe:"
-LONG_ARGS = ["initialise", "help", "encrypt="]
+SHORT_ARGS = "ihe:rzx:I:"
+LONG_ARGS = [
+    "initialise", "help", "encrypt=", "rehash", "compress", "exclude=",
+    "include="
+]
 
 
 bucket_config = {'LocationConstraint': 'ap-southeast-2'}
 
 
-def md5_hash(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as infile:
-        for chunk in iter(lambda: infile.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-
-def upload_file(s3_resource, path, file_hash, modtime, extra_args=None):
-    print(f"Uploading  { path }")
+def upload_file(s3_resource, path, file_hash, modtime, extra_args=None,
+                compress=False):
     metadata = {
         "Metadata": {
             "ModificationTime": modtime,
             "Md5Hash": file_hash
         }
     }
+    codec = file_codec(path) if compress else None
+    if codec:
+        print(f"Uploading  { path } compressed with {codec}")
+        metadata["Metadata"][CODEC_METADATA] = codec
+        upload_stream(
+            s3_resource.meta.client,
+            ROOT_S3_DIR,
+            path,
+            compress_file(path, codec),
+            extra_args={**(extra_args or {}), **metadata}
+        )
+        return
+    print(f"Uploading  { path }")
     if extra_args:
         args = {**extra_args, **metadata}
     else:
@@ -57,6 +74,13 @@ def print_help():
         "Usage cloudstorage.py [OPTION]\n"
         "Uploads the files in a given directory to S3\n"
         "-i, --initialise\tCreate a new S3 bucket\n"
+        "-r, --rehash\tHash every file even if the stat cache says it's "
+        "unchanged\n"
+        "-z, --compress\tCompress files that compress well before "
+        "uploading them\n"
+        f"-x, --exclude GLOB\tSkip files and directories matching GLOB, "
+        f"as well as {', '.join(DEFAULT_EXCLUDES)}\n"
+        "-I, --include GLOB\tOnly upload files matching GLOB\n"
         "-h, --help\tDisplay this help menu then quit\n"
     )
 
@@ -80,6 +104,10 @@ def create_bucket(s3_client):
 def main():
     opts = getopt.getopt(sys.argv[1:], SHORT_ARGS, LONG_ARGS)[0]
     initialise = False
+    rehash = False
+    compress = False
+    includes = []
+    excludes = list(DEFAULT_EXCLUDES)
     enc_key_alias = ""
     extra_args = {}
     s3_client = boto3.client("s3")
@@ -91,8 +119,16 @@ def main():
         elif opt[0] == '-h' or opt[0] == '--help':
             print_help()
             return
+        elif opt[0] == '-r' or opt[0] == '--rehash':
+            rehash = True
         elif opt[0] == '-e' or opt[0] == '--encrypt':
             enc_key_alias = opt[1]
+        elif opt[0] == '-z' or opt[0] == '--compress':
+            compress = True
+        elif opt[0] == '-x' or opt[0] == '--exclude':
+            excludes.append(opt[1])
+        elif opt[0] == '-I' or opt[0] == '--include':
+            includes.append(opt[1])
 
     if initialise:
         if not create_bucket(s3_client):
@@ -100,27 +136,38 @@ def main():
 
     # Fetch the KMS key for encrypting files if required
     if enc_key_alias:
-        keys = kms.list_keys()["Keys"]
-        for key in keys:
-            key_id = key["KeyId"]
-            aliases = kms.list_aliases(KeyId=key_id)["Aliases"]
-            aliases = [alias["AliasName"] for alias in aliases]
-            if f"alias/{enc_key_alias}" in aliases:
-                extra_args["ServerSideEncryption"] = "aws:kms"
-                extra_args["SSEKMSKeyId"] = key_id
+        key_id = resolve_alias(kms, enc_key_alias)
+        if key_id:
+            extra_args["ServerSideEncryption"] = "aws:kms"
+            extra_args["SSEKMSKeyId"] = key_id
 
     # parse directory and upload files
 
-    for dir_name, subdir, file_list in os.walk(ROOT_DIR, topdown=True):
-        if dir_name != ROOT_DIR:
-            for fname in file_list:
-                path = f"{dir_name[2:]}/{fname}"
-                print(path + '\n')
-                modtime = datetime.fromtimestamp(
-                    os.stat(path).st_mtime
-                ).strftime("%c")
-                file_hash = md5_hash(path)
-                upload_file(s3_resource, path, file_hash, modtime, extra_args)
+    with StatCache(ROOT_DIR, rehash=rehash) as cache:
+        # Files are hashed a few at a time on threads ahead of the uploads,
+        # going through the cache so unchanged files aren't read
+        entries = hash_files(
+            scan(ROOT_DIR, PathFilter(includes, excludes)),
+            hash_func=lambda entry: cache.hash(entry[0], entry[2])
+        )
+        for (path, fname, st), file_hash in entries:
+            print(path + '\n')
+            modtime = datetime.fromtimestamp(st.st_mtime).strftime("%c")
+            try:
+                upload_file(
+                    s3_resource, path, file_hash, modtime, extra_args, compress
+                )
+            except Exception as e:
+                # The cached key id may be for a key that's since been deleted
+                if not enc_key_alias or not is_key_not_found(e):
+                    raise
+                key_id = resolve_alias(kms, enc_key_alias, refresh=True)
+                if not key_id or key_id == extra_args["SSEKMSKeyId"]:
+                    raise
+                extra_args["SSEKMSKeyId"] = key_id
+                upload_file(
+                    s3_resource, path, file_hash, modtime, extra_args, compress
+                )
     print("done")
 
 
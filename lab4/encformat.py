@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Chunked, authenticated encryption format used by cs_enc.py
+
+An encrypted object is a HEADER followed by the plaintext split into
+fixed-size segments, each encrypted on its own with AES-GCM:
+
+    magic (8) | version (1) | reserved (3) | segment size (4) | nonce (8)
+    segment 0 ciphertext | tag (16)
+    segment 1 ciphertext | tag (16)
+    ...
+
+Every segment but the last holds exactly segment size bytes of plaintext,
+so the segments double as their own index: segment i starts at
+HEADER.size + i * (segment size + TAG_SIZE) and any plaintext byte range
+can be decrypted by fetching only the segments covering it. Each segment's
+nonce is the header nonce followed by its index, and its associated data is
+the header, its index and whether it is the last segment, so segments can't
+be reordered, swapped between objects or truncated without detection.
+
+The magic number read as the little-endian size field of the original CBC
+format would be an absurd file size, so the two formats can't be confused.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from collections import namedtuple
+import struct
+from Crypto.Cipher import AES
+from Crypto import Random
+
+MAGIC = b"\x89CSENC\r\n"
+VERSION = 2
+HEADER = struct.Struct("<8sB3xI8s")
+TAG_SIZE = 16
+SEGMENT_SIZE = 64 * 1024
+
+Header = namedtuple("Header", ["raw", "segment_size", "nonce"])
+
+
+def is_segmented(prefix):
+    """Returns True if prefix, the first bytes of an encrypted object, are
+    in this format rather than the original CBC one
+    """
+    return prefix[:len(MAGIC)] == MAGIC
+
+
+def new_header(segment_size=SEGMENT_SIZE):
+    nonce = Random.new().read(8)
+    raw = HEADER.pack(MAGIC, VERSION, segment_size, nonce)
+    return Header(raw, segment_size, nonce)
+
+
+def parse_header(raw):
+    magic, version, segment_size, nonce = HEADER.unpack(raw[:HEADER.size])
+    if magic != MAGIC:
+        raise ValueError("not a segmented encrypted object")
+    if version != VERSION:
+        raise ValueError(f"unsupported format version {version}")
+    return Header(raw[:HEADER.size], segment_size, nonce)
+
+
+def _cipher(key, header, index, final):
+    cipher = AES.new(
+        key, AES.MODE_GCM, nonce=header.nonce + struct.pack(">I", index)
+    )
+    cipher.update(header.raw + struct.pack("<QB", index, final))
+    return cipher
+
+
+def encrypt_segment(key, header, index, data, final):
+    ciphertext, tag = _cipher(key, header, index, final).encrypt_and_digest(
+        data
+    )
+    return ciphertext + tag
+
+
+def decrypt_segment(key, header, index, blob, final):
+    """Decrypts one segment, raising ValueError if it has been tampered
+    with
+    """
+    return _cipher(key, header, index, final).decrypt_and_verify(
+        blob[:-TAG_SIZE], blob[-TAG_SIZE:]
+    )
+
+
+def stored_segment_size(header):
+    return header.segment_size + TAG_SIZE
+
+
+def encrypted_size(plaintext_size, segment_size=SEGMENT_SIZE):
+    segments = max(1, -(-plaintext_size // segment_size))
+    return HEADER.size + plaintext_size + segments * TAG_SIZE
+
+
+def segment_count(header, object_size):
+    body = object_size - HEADER.size
+    return max(1, -(-body // stored_segment_size(header)))
+
+
+def encrypt_chunks(key, chunks, segment_size=SEGMENT_SIZE):
+    """Yields the encrypted form of the concatenated chunks, header first,
+    one segment at a time. chunks can be any iterable of bytes
+    """
+    header = new_header(segment_size)
+    yield header.raw
+    buf = bytearray()
+    index = 0
+    for chunk in chunks:
+        buf += chunk
+        # Hold back a full segment until we know whether it's the last
+        while len(buf) > segment_size:
+            yield encrypt_segment(
+                key, header, index, bytes(buf[:segment_size]), False
+            )
+            del buf[:segment_size]
+            index += 1
+    yield encrypt_segment(key, header, index, bytes(buf), True)
+
+
+def encrypt_stream(key, infile, segment_size=SEGMENT_SIZE):
+    return encrypt_chunks(
+        key, iter(lambda: infile.read(segment_size), b""), segment_size
+    )
+
+
+def decrypt_stream(key, infile, outfile, prefix=b""):
+    """Decrypts a readable infile into outfile. prefix holds any bytes
+    already read from the start of infile
+    """
+    raw = prefix + infile.read(HEADER.size - len(prefix))
+    header = parse_header(raw)
+    size = stored_segment_size(header)
+    index = 0
+    blob = infile.read(size)
+    while True:
+        next_blob = infile.read(size)
+        final = not next_blob
+        outfile.write(decrypt_segment(key, header, index, blob, final))
+        if final:
+            return
+        blob = next_blob
+        index += 1
+
+
+def segment_span(header, object_size, start, end):
+    """Returns (first, last, ct_start, ct_end), the segments holding the
+    inclusive plaintext byte range start-end and the inclusive range of the
+    object they're stored in
+    """
+    size = stored_segment_size(header)
+    last_segment = segment_count(header, object_size) - 1
+    first = min(start // header.segment_size, last_segment)
+    last = min(end // header.segment_size, last_segment)
+    ct_start = HEADER.size + first * size
+    ct_end = min(HEADER.size + (last + 1) * size, object_size) - 1
+    return first, last, ct_start, ct_end
+
+
+def decrypt_range(key, read_at, object_size, start, end):
+    """Returns plaintext bytes start-end (inclusive) of an encrypted object
+    by fetching only the header and the segments covering that range.
+    read_at(offset, length) must return length bytes of the object from
+    offset, e.g. with a ranged GET
+    """
+    header = parse_header(read_at(0, HEADER.size))
+    first, last, ct_start, ct_end = segment_span(
+        header, object_size, start, end
+    )
+    data = read_at(ct_start, ct_end - ct_start + 1)
+    final_index = segment_count(header, object_size) - 1
+    size = stored_segment_size(header)
+    plaintext = bytearray()
+    for index in range(first, last + 1):
+        offset = (index - first) * size
+        plaintext += decrypt_segment(
+            key, header, index, data[offset:offset + size],
+            index == final_index
+        )
+    skip = start - first * header.segment_size
+    return bytes(plaintext[skip:skip + end - start + 1])
@@ -7,6 +7,7 @@ __copyright__ = "Copyright 2020"
 """
 import boto3
 import json
+from kmskeys import call_with_key
 
 KEY_DESC = "22487668-testkey"
 ALIAS = "22487668Key"
@@ -20,24 +21,17 @@ with open(JSON_FILE, "r") as infile:
 
 
 def apply_policy(alias, kms):
-    keys = kms.list_keys()["Keys"]
-    desired_key_id = ""
-    for key in keys:
-        key_id = key["KeyId"]
-        aliases = kms.list_aliases(KeyId=key_id)["Aliases"]
-        aliases = [alias["AliasName"] for alias in aliases]
-        if f"alias/{alias}" in aliases:
-            desired_key_id = key_id
-            break
-    if not desired_key_id:
-        raise Exception(f"Can't find a key id for the alias {alias}")
-
-    resp = kms.put_key_policy(
-        KeyId=desired_key_id,
-        PolicyName="default",
-        Policy=policy,
-        BypassPolicyLockoutSafetyCheck=False
+    resp = call_with_key(
+        kms, alias,
+        lambda key_id: kms.put_key_policy(
+            KeyId=key_id,
+            PolicyName="default",
+            Policy=policy,
+            BypassPolicyLockoutSafetyCheck=False
+        )
     )
+    if resp is None:
+        raise Exception(f"Can't find a key id for the alias {alias}")
     print(resp)
 
 
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Resolves KMS key aliases to key ids
+
+describe_key accepts an alias directly, so a lookup is a single API call no
+matter how many keys the account has. Results are kept in a small JSON file
+under ~/.cache for CACHE_TTL seconds, keyed by account and region, so
+repeated runs only need STS to say which account they're in. An id KMS
+says no longer exists is dropped and the alias resolved again.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+import json
+import os
+import time
+import boto3
+
+CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "cits5503", "kms-aliases.json"
+)
+CACHE_TTL = 60 * 60
+
+
+def _load_cache():
+    try:
+        with open(CACHE_PATH, "r") as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache):
+    os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+    tmp = f"{CACHE_PATH}.{os.getpid()}"
+    with open(tmp, "w") as outfile:
+        json.dump(cache, outfile)
+    os.replace(tmp, CACHE_PATH)
+
+
+def caller_account(kms):
+    """Returns the id of the account kms's credentials belong to"""
+    sts = boto3.client("sts", region_name=kms.meta.region_name)
+    return sts.get_caller_identity()["Account"]
+
+
+def _alias_name(alias):
+    return alias if alias.startswith("alias/") else f"alias/{alias}"
+
+
+def _cache_key(kms, alias, account):
+    return f"{account}:{kms.meta.region_name}:{_alias_name(alias)}"
+
+
+def resolve_alias(kms, alias, ttl=CACHE_TTL, account=None, refresh=False):
+    """Returns the id of the key alias points at, or None if there's no
+    such alias. alias may be given with or without the alias/ prefix.
+    Cached ids are per account, which is looked up if not given, so
+    switching credentials can't return another account's key. refresh
+    skips the cache
+    """
+    name = _alias_name(alias)
+    account = account or caller_account(kms)
+    cache_key = _cache_key(kms, name, account)
+    cache = _load_cache()
+    entry = cache.get(cache_key)
+    if not refresh and entry and time.time() - entry["fetched"] < ttl:
+        return entry["key_id"]
+
+    try:
+        key_id = kms.describe_key(KeyId=name)["KeyMetadata"]["KeyId"]
+    except kms.exceptions.NotFoundException:
+        if cache.pop(cache_key, None):
+            _save_cache(cache)
+        return None
+    cache[cache_key] = {"key_id": key_id, "fetched": time.time()}
+    _save_cache(cache)
+    return key_id
+
+
+def is_key_not_found(e):
+    """Returns True if e is KMS saying a key doesn't exist, whether it came
+    from KMS itself or from S3 using the key
+    """
+    code = getattr(e, "response", {}).get("Error", {}).get("Code")
+    if code in ("NotFoundException", "KMS.NotFoundException"):
+        return True
+    # S3's managed transfers wrap the error in S3UploadFailedError
+    return "KMS.NotFoundException" in str(e)
+
+
+def call_with_key(kms, alias, func, account=None):
+    """Returns func(key_id) for the key alias points at, or None if there's
+    no such alias. If KMS rejects a cached id as not found, the alias is
+    resolved again and func retried once with the new id
+    """
+    account = account or caller_account(kms)
+    key_id = resolve_alias(kms, alias, account=account)
+    if key_id is None:
+        return None
+    try:
+        return func(key_id)
+    except Exception as e:
+        if not is_key_not_found(e):
+            raise
+        fresh = resolve_alias(kms, alias, account=account, refresh=True)
+        if fresh is None or fresh == key_id:
+            raise
+        return func(fresh)
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Multi-core encryption and decryption in the encformat.py format
+
+Segments are independent, so runs of them from one large file, or from
+many files, are spread over a process pool. Workers memory map the input
+themselves and write their output straight into the destination file with
+positional writes, or into a shared memory buffer when the result is being
+streamed to S3, so no file data is pickled between processes. Small files
+are encrypted whole, each into a buffer of its own, several at a time.
+
+Running this module directly benchmarks serial against parallel encryption
+of a generated file.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from multiprocessing import resource_tracker, shared_memory
+import getopt
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+import time
+import encformat
+from encformat import (
+    HEADER, SEGMENT_SIZE, decrypt_segment, encrypt_segment, new_header,
+    parse_header, segment_count, stored_segment_size
+)
+
+DEFAULT_WORKERS = os.cpu_count() or 4
+# Segments handed to a worker at a time, 4 MiB with the default segment size
+RUN_SEGMENTS = 64
+
+
+def pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _mapped(infile):
+    """Memory maps a file opened for reading, mmap can't map empty files"""
+    if os.fstat(infile.fileno()).st_size == 0:
+        return nullcontext(b"")
+    return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def process_pool(workers=DEFAULT_WORKERS):
+    """Returns a process pool whose workers share this process's resource
+    tracker, which only happens if it's running before they start. Without
+    that each worker would start a tracker of its own that unlinks any
+    shared memory it attached to when the worker exits
+    """
+    resource_tracker.ensure_running()
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def _attach(name):
+    """Attaches to a block created by the parent, which registered it with
+    the resource tracker and is the one to unlink it
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block again, with the
+        # tracker shared with the parent, which is harmless
+        return shared_memory.SharedMemory(name=name)
+
+
+def _segment_runs(total, run_segments):
+    return [
+        (first, min(run_segments, total - first))
+        for first in range(0, total, run_segments)
+    ]
+
+
+def _encrypted_buffer(header, total):
+    return shared_memory.SharedMemory(
+        create=True, size=total * stored_segment_size(header)
+    )
+
+
+def _encrypt_run(key, header, in_path, first, count, total, write):
+    seg = header.segment_size
+    with open(in_path, "rb") as infile, _mapped(infile) as mapped:
+        with memoryview(mapped) as data:
+            for index in range(first, first + count):
+                start = index * seg
+                write(
+                    index - first,
+                    encrypt_segment(
+                        key, header, index, data[start:start + seg],
+                        index == total - 1
+                    )
+                )
+
+
+def _encrypt_run_to_file(key, header, in_path, out_path, first, count,
+                         total):
+    fd = os.open(out_path, os.O_WRONLY)
+    size = stored_segment_size(header)
+    try:
+        _encrypt_run(
+            key, header, in_path, first, count, total,
+            lambda i, blob: pwrite_all(
+                fd, blob, HEADER.size + (first + i) * size
+            )
+        )
+    finally:
+        os.close(fd)
+
+
+def _encrypt_run_to_shm(key, header, in_path, first, count, total, name):
+    shm = _attach(name)
+    size = stored_segment_size(header)
+    written = [0]
+
+    def write(i, blob):
+        shm.buf[i * size:i * size + len(blob)] = blob
+        written[0] = i * size + len(blob)
+
+    try:
+        _encrypt_run(key, header, in_path, first, count, total, write)
+    finally:
+        shm.close()
+    return written[0]
+
+
+def _decrypt_run_to_file(key, header, in_path, out_path, first, count,
+                         total):
+    size = stored_segment_size(header)
+    fd = os.open(out_path, os.O_WRONLY)
+    try:
+        with open(in_path, "rb") as infile, _mapped(infile) as mapped:
+            with memoryview(mapped) as data:
+                for index in range(first, first + count):
+                    start = HEADER.size + index * size
+                    pwrite_all(
+                        fd,
+                        decrypt_segment(
+                            key, header, index, data[start:start + size],
+                            index == total - 1
+                        ),
+                        index * header.segment_size
+                    )
+    finally:
+        os.close(fd)
+
+
+def _prepare_encrypt(in_path, out_path, segment_size):
+    header = new_header(segment_size)
+    plaintext_size = os.path.getsize(in_path)
+    total = max(1, -(-plaintext_size // segment_size))
+    with open(out_path, "wb") as outfile:
+        outfile.write(header.raw)
+        outfile.truncate(
+            encformat.encrypted_size(plaintext_size, segment_size)
+        )
+    return header, total
+
+
+def encrypt_files(jobs, pool, segment_size=SEGMENT_SIZE,
+                  run_segments=RUN_SEGMENTS):
+    """Encrypts each (key, in_path, out_path) in jobs using the process
+    pool, so separate files are encrypted at the same time and large files
+    are split into runs of segments to keep every worker busy
+    """
+    futures = []
+    for key, in_path, out_path in jobs:
+        header, total = _prepare_encrypt(in_path, out_path, segment_size)
+        for first, count in _segment_runs(total, run_segments):
+            futures.append(pool.submit(
+                _encrypt_run_to_file, key, header, in_path, out_path,
+                first, count, total
+            ))
+    for future in futures:
+        future.result()
+
+
+def encrypt_file_parallel(key, in_path, out_path, pool, **kwargs):
+    encrypt_files([(key, in_path, out_path)], pool, **kwargs)
+
+
+def decrypt_file_parallel(key, in_path, out_path, pool,
+                          run_segments=RUN_SEGMENTS):
+    object_size = os.path.getsize(in_path)
+    with open(in_path, "rb") as infile:
+        header = parse_header(infile.read(HEADER.size))
+    total = segment_count(header, object_size)
+    plaintext_size = object_size - HEADER.size - total * encformat.TAG_SIZE
+    with open(out_path, "wb") as outfile:
+        outfile.truncate(plaintext_size)
+    futures = [
+        pool.submit(
+            _decrypt_run_to_file, key, header, in_path, out_path,
+            first, count, total
+        )
+        for first, count in _segment_runs(total, run_segments)
+    ]
+    for future in futures:
+        future.result()
+
+
+def encrypt_stream(key, in_path, pool, window=DEFAULT_WORKERS,
+                   segment_size=SEGMENT_SIZE, run_segments=RUN_SEGMENTS):
+    """Yields the encrypted contents of in_path like encformat's
+    encrypt_stream, with up to window runs of segments being encrypted by
+    the pool at once. Workers write into a ring of shared memory buffers
+    rather than pickling their output back. The pool has to come from
+    process_pool
+    """
+    header = new_header(segment_size)
+    yield header.raw
+    plaintext_size = os.path.getsize(in_path)
+    total = max(1, -(-plaintext_size // segment_size))
+    buffers = [
+        _encrypted_buffer(header, run_segments) for _ in range(window)
+    ]
+    pending = deque()
+    try:
+        for i, (first, count) in enumerate(_segment_runs(total, run_segments)):
+            if len(pending) == window:
+                buf, future = pending.popleft()
+                yield bytes(buf.buf[:future.result()])
+            buf = buffers[i % window]
+            pending.append((buf, pool.submit(
+                _encrypt_run_to_shm, key, header, in_path, first, count,
+                total, buf.name
+            )))
+        while pending:
+            buf, future = pending.popleft()
+            yield bytes(buf.buf[:future.result()])
+    finally:
+        for _, future in pending:
+            future.cancel()
+        for buf in buffers:
+            _release(buf)
+
+
+def _release(buf):
+    buf.close()
+    buf.unlink()
+
+
+def _collect(header, buf, future):
+    try:
+        return [header.raw, bytes(buf.buf[:future.result()])]
+    finally:
+        _release(buf)
+
+
+def encrypt_small_files(jobs, pool, window=DEFAULT_WORKERS * 2,
+                        segment_size=SEGMENT_SIZE):
+    """Yields the encrypted contents of each (key, in_path) in jobs in
+    order, as a list of chunks like encrypt_stream's, with up to window
+    files being encrypted by the pool at once, each into a shared memory
+    buffer of its own. Each file is held in memory whole, so this is for
+    files well under a run of segments. The pool has to come from
+    process_pool
+    """
+    pending = deque()
+    try:
+        for key, in_path in jobs:
+            if len(pending) == window:
+                yield _collect(*pending.popleft())
+            header = new_header(segment_size)
+            total = max(1, -(-os.path.getsize(in_path) // segment_size))
+            buf = _encrypted_buffer(header, total)
+            try:
+                future = pool.submit(
+                    _encrypt_run_to_shm, key, header, in_path, 0, total,
+                    total, buf.name
+                )
+            except BaseException:
+                _release(buf)
+                raise
+            pending.append((header, buf, future))
+        while pending:
+            yield _collect(*pending.popleft())
+    finally:
+        for _, buf, future in pending:
+            future.cancel()
+            _release(buf)
+
+
+def _time(label, func, total_bytes):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<28}{elapsed:8.3f}s"
+        f"{total_bytes / elapsed / 1024 ** 2:10.1f} MiB/s"
+    )
+
+
+def benchmark(file_size, workers):
+    root = tempfile.mkdtemp()
+    key = os.urandom(32)
+    plain = os.path.join(root, "plain")
+    serial_out = os.path.join(root, "serial.enc")
+    parallel_out = os.path.join(root, "parallel.enc")
+    restored = os.path.join(root, "restored")
+    try:
+        with open(plain, "wb") as outfile:
+            outfile.write(os.urandom(file_size))
+        print(f"Encrypting {file_size} bytes with {workers} workers\n")
+
+        def serial():
+            with open(plain, "rb") as infile:
+                with open(serial_out, "wb") as outfile:
+                    for chunk in encformat.encrypt_stream(key, infile):
+                        outfile.write(chunk)
+
+        with process_pool(workers) as pool:
+            _time("serial encrypt", serial, file_size)
+            _time(
+                "parallel encrypt",
+                lambda: encrypt_file_parallel(key, plain, parallel_out, pool),
+                file_size
+            )
+            _time(
+                "parallel stream encrypt",
+                lambda: sum(map(len, encrypt_stream(key, plain, pool))),
+                file_size
+            )
+            _time(
+                "parallel decrypt",
+                lambda: decrypt_file_parallel(
+                    key, parallel_out, restored, pool
+                ),
+                file_size
+            )
+        with open(plain, "rb") as a, open(restored, "rb") as b:
+            assert a.read() == b.read()
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    opts = getopt.getopt(sys.argv[1:], "s:w:", ["size=", "workers="])[0]
+    file_size = 256 * 1024 * 1024
+    workers = DEFAULT_WORKERS
+    for opt in opts:
+        if opt[0] == '-s' or opt[0] == '--size':
+            file_size = int(opt[1])
+        elif opt[0] == '-w' or opt[0] == '--workers':
+            workers = int(opt[1])
+    benchmark(file_size, workers)
+
+
+if __name__ == "__main__":
+    main()
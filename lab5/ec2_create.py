@@ -1,58 +1,90 @@
 #!/usr/bin/env python3
 """
-Simple script for creating two EC2 instances in two different
-AZs and removing them
+Simple script for creating EC2 instances in several AZs behind a load
+balancer, stopping them again if anything goes wrong
+
+The instances for every AZ are launched at once and the load balancer,
+target group and listener are created while they boot, with each instance
+registered as a target as soon as it's running. By default one instance is
+launched in each of ap-southeast-2c and ap-southeast-2b, which -z/--zones
+changes, e.g. -z c:2,b:2,a
 
 __author__ = "Eddie Atkinson"
 __copyright__ = "Copyright 2020"
 """
+from concurrent.futures import ThreadPoolExecutor
+import getopt
+import os
 import pprint
+import sys
 import boto3
 
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+)
+from common.ec2fleet import (
+    launch_fleet, stop_fleet, tag_value, wait_for_fleet
+)
+
 # Set your keyname, security group name and VPC ID below
 
 KEY_NAME = ""
 SG_NAME = ""
 VPC_ID = ""
 
+REGION = "ap-southeast-2"
+# Application load balancers need subnets in at least two AZs
+MIN_ZONES = 2
+DEFAULT_ZONES = [(f"{REGION}c", 1), (f"{REGION}b", 1)]
+
 
 def stop_instances(ec2_client, instance_ids):
     print(f"Stopping {', '.join(instance_ids)}")
-    ec2_client.stop_instances(InstanceIds=instance_ids)
-
-
-def create_instances(ec2_resource, az):
-    instances = ec2_resource.create_instances(
+    for result in stop_fleet(ec2_client, instance_ids, wait=False):
+        if result.error:
+            print(f"Unable to stop {result.id}: {result.error}")
+
+
+def create_instances(ec2_client, az, count=1):
+    """Launches count instances in az without waiting for them, returning
+    their ids
+    """
+    instance_ids = launch_fleet(
+        ec2_client,
+        count,
+        {"Name": f"22487668_{az[-1]}"},
         ImageId="ami-d38a4ab1",
-        MinCount=1,
-        MaxCount=1,
         InstanceType="t2.micro",
         KeyName=KEY_NAME,
         SecurityGroups=[SG_NAME],
         Placement={
-            "AvailabilityZone": f"ap-southeast-2{az}"
+            "AvailabilityZone": az
         }
     )
-    instance_ids = []
-    for instance in instances:
-        instance.wait_until_running()
-        instance.create_tags(
-            Tags=[{"Key": "Name", "Value": f"22487668_{az}"}]
-        )
-        instance_ids.append(instance.id)
-        print(f"{instance.id}\t{instance.tags[0]['Value']} is running")
+    print(f"Launched {', '.join(instance_ids)} in {az}")
     return instance_ids
 
 
-def get_subnet_ids(ec2_client, instance_ids):
-    subnet_ids = []
-    instances = ec2_client.describe_instances(
-        InstanceIds=instance_ids
-    )["Reservations"]
-    for instance in instances:
-        instance = instance["Instances"][0]
-        subnet_ids.append(instance["SubnetId"])
-    return(subnet_ids)
+def get_subnet_ids(ec2_client, azs):
+    """Returns a subnet of the VPC in each of azs, the default one where
+    there is one, so the load balancer can be made before any instances
+    are up. Raises if any of azs has no subnet in the VPC
+    """
+    subnets = ec2_client.describe_subnets(
+        Filters=[
+            {"Name": "vpc-id", "Values": [VPC_ID]},
+            {"Name": "availability-zone", "Values": list(azs)}
+        ]
+    )["Subnets"]
+    by_az = {}
+    for subnet in sorted(subnets, key=lambda subnet: subnet["DefaultForAz"]):
+        by_az[subnet["AvailabilityZone"]] = subnet["SubnetId"]
+    missing = [az for az in azs if az not in by_az]
+    if missing:
+        raise Exception(
+            f"VPC {VPC_ID} has no subnet in {', '.join(missing)}"
+        )
+    return [by_az[az] for az in azs]
 
 
 def get_sg_id(ec2_client):
@@ -79,19 +111,32 @@ def create_elb(elb, subnet_ids, sg_id):
     return resp["LoadBalancerArn"]
 
 
-def set_target_group(elb, instance_ids):
+def create_target_group(elb):
     resp = elb.create_target_group(
         Name="22487668-targetgroup",
         Protocol="HTTP",
         Port=80,
         VpcId=VPC_ID
     )["TargetGroups"]
-    tg_arn = resp[0]["TargetGroupArn"]
+    return resp[0]["TargetGroupArn"]
+
+
+def register_instances(elb, tg_arn, instance_ids):
     targets = [{"Id": id} for id in instance_ids]
     elb.register_targets(
         TargetGroupArn=tg_arn,
         Targets=targets
     )
+
+
+def create_load_balancer(ec2_client, elb, subnet_ids):
+    """Creates the load balancer, target group and listener, returning the
+    target group's ARN
+    """
+    sg_id = get_sg_id(ec2_client)
+    elb_arn = create_elb(elb, subnet_ids, sg_id)
+    tg_arn = create_target_group(elb)
+    attach_listener(elb, elb_arn, tg_arn)
     return tg_arn
 
 
@@ -108,23 +153,86 @@ def attach_listener(elb, elb_arn, tg_arn):
     pprint.pprint(resp)
 
 
+def deploy(ec2_client, elb, zones):
+    """Launches the instances for every AZ in zones, a list of (AZ, count),
+    at once and sets up the load balancer while they boot, registering
+    each instance with it as soon as it's running. Returns the ids of the
+    instances launched
+    """
+    # Checked before launching so a missing subnet can't strand instances
+    subnet_ids = get_subnet_ids(ec2_client, [az for az, _ in zones])
+    instance_ids = []
+    with ThreadPoolExecutor(max_workers=len(zones) + 1) as pool:
+        balancer = pool.submit(
+            create_load_balancer, ec2_client, elb, subnet_ids
+        )
+        launches = [
+            pool.submit(create_instances, ec2_client, az, count)
+            for az, count in zones
+        ]
+        try:
+            for launch in launches:
+                instance_ids.extend(launch.result())
+            tg_arn = None
+            for instance in wait_for_fleet(ec2_client, instance_ids):
+                name = tag_value(instance, "Name", "No name")
+                state = instance["State"]["Name"]
+                print(f"{instance['InstanceId']}\t{name} is {state}")
+                if state != "running":
+                    continue
+                if tg_arn is None:
+                    tg_arn = balancer.result()
+                register_instances(elb, tg_arn, [instance["InstanceId"]])
+            balancer.result()
+        except BaseException:
+            # Whatever did launch shouldn't be left running
+            launched = []
+            for launch in launches:
+                if not launch.exception():
+                    launched.extend(launch.result())
+            if launched:
+                stop_instances(ec2_client, launched)
+            raise
+    return instance_ids
+
+
+def parse_zones(arg):
+    """Parses a list of AZs like "c:2,b" or "ap-southeast-2a:3" into
+    (AZ, count), with AZs given as a single letter taken to be in REGION.
+    An AZ given more than once gets the sum of its counts. Raises if
+    fewer than MIN_ZONES AZs are given
+    """
+    zones = {}
+    for zone in arg.split(","):
+        az, _, count = zone.strip().partition(":")
+        if len(az) == 1:
+            az = f"{REGION}{az}"
+        zones[az] = zones.get(az, 0) + int(count or 1)
+    if len(zones) < MIN_ZONES:
+        raise ValueError(
+            f"The load balancer needs at least {MIN_ZONES} AZs, got "
+            f"{', '.join(zones)}"
+        )
+    return list(zones.items())
+
+
 def main():
-    ec2_resource = boto3.resource("ec2")
+    opts = getopt.getopt(sys.argv[1:], "z:", ["zones="])[0]
+    zones = DEFAULT_ZONES
+    for opt in opts:
+        if opt[0] == '-z' or opt[0] == '--zones':
+            try:
+                zones = parse_zones(opt[1])
+            except ValueError as e:
+                print(e)
+                return
     ec2_client = boto3.client("ec2")
     elbv2 = boto3.client("elbv2")
 
-    instance_ids = []
-    instance_ids.append(*create_instances(ec2_resource, "c"))
-    instance_ids.append(*create_instances(ec2_resource, "b"))
-    subnet_ids = get_subnet_ids(ec2_client, instance_ids)
     try:
-        sg_id = get_sg_id(ec2_client)
-        elb_arn = create_elb(elbv2, subnet_ids, sg_id)
-        tg_arn = set_target_group(elbv2, instance_ids)
-        attach_listener(elbv2, elb_arn, tg_arn)
+        deploy(ec2_client, elbv2, zones)
     except Exception as e:
         print(e)
-        stop_instances(ec2_client, instance_ids)
 
 
 if __name__ == "__main__":
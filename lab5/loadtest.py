@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+HTTP load generator for the load balancer and nginx stack
+
+    loadtest.py run [options] URL...
+    loadtest.py serve [-p port] [-r root]
+
+run sends GET requests to each URL in turn from concurrency connections,
+for duration seconds, and reports the throughput and latency percentiles
+and histogram of every target. With a rate the requests are sent on a
+fixed schedule, and latency is measured from when each request was due
+rather than when it went out, so a stalled server can't hide its stalls
+by slowing the test down. -l/--local starts the stand-in server in the
+same process and adds it as a target, so the harness can be tried without
+AWS or docker.
+
+serve runs that stand-in, a small keep-alive HTTP server for the files in
+lab2/html, the same ones the lab2 nginx container serves.
+
+Only the standard library is used, with plain http:// and https:// URLs.
+
+__author__ = "Eddie Atkinson"
+__copyright__ = "Copyright 2020"
+"""
+import asyncio
+import getopt
+import itertools
+import math
+import os
+import ssl
+import sys
+import time
+from urllib.parse import urlsplit
+
+DEFAULT_CONCURRENCY = 10
+DEFAULT_DURATION = 10.0
+DEFAULT_PORT = 8080
+DEFAULT_ROOT = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "lab2", "html"
+)
+REQUEST_TIMEOUT = 10.0
+# Histogram buckets double from 0.1ms to about 100s
+BUCKET_START = 0.0001
+N_BUCKETS = 21
+BAR_WIDTH = 40
+PERCENTILES = (50, 95, 99)
+CONTENT_TYPES = {
+    ".html": "text/html", ".css": "text/css", ".js": "text/javascript",
+    ".png": "image/png", ".jpg": "image/jpeg", ".ico": "image/x-icon",
+}
+
+
+class Target:
+    """A URL being tested and the results of every request sent to it"""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError(f"{url} isn't an http:// or https:// URL")
+        self.url = url
+        self.ssl = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.ssl else 80)
+        self.path = parts.path or "/"
+        if parts.query:
+            self.path += f"?{parts.query}"
+        self.netloc = parts.netloc
+        self.latencies = []
+        self.statuses = {}
+        self.errors = {}
+        self.bytes = 0
+
+
+class Connection:
+    """A keep-alive HTTP/1.1 connection to one target"""
+
+    def __init__(self, target):
+        self.target = target
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        context = ssl.create_default_context() if self.target.ssl else None
+        self.reader, self.writer = await asyncio.open_connection(
+            self.target.host, self.target.port, ssl=context
+        )
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def get(self):
+        """Sends a GET and returns (status, body length), closing the
+        connection afterwards if the server asked to
+        """
+        if self.writer is None:
+            await self.open()
+        self.writer.write(
+            f"GET {self.target.path} HTTP/1.1\r\n"
+            f"Host: {self.target.netloc}\r\n"
+            f"User-Agent: loadtest\r\n"
+            f"Connection: keep-alive\r\n\r\n".encode()
+        )
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        status = int(status_line.split()[1])
+        headers = await read_headers(self.reader)
+        length = await read_body(self.reader, headers)
+        if headers.get("connection", "").lower() == "close" or length is None:
+            self.close()
+        return status, length or 0
+
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def read_body(reader, headers):
+    """Reads a response body and returns its length, or None if it ran
+    until the connection closed
+    """
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        length = 0
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            if size == 0:
+                await read_headers(reader)
+                return length
+            await reader.readexactly(size + 2)
+            length += size
+    if "content-length" in headers:
+        length = int(headers["content-length"])
+        await reader.readexactly(length)
+        return length
+    return len(await reader.read())
+
+
+class Schedule:
+    """Hands out the times requests are due, rate a second from start, or
+    as soon as possible if rate is None
+    """
+
+    def __init__(self, start, rate):
+        self.start = start
+        self.rate = rate
+        self._count = itertools.count()
+
+    def next_due(self):
+        if self.rate is None:
+            return time.monotonic()
+        return self.start + next(self._count) / self.rate
+
+
+async def worker(targets, schedule, deadline):
+    connections = {}
+    try:
+        for target in targets:
+            due = schedule.next_due()
+            if due >= deadline:
+                return
+            wait = due - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            connection = connections.get(target)
+            if connection is None:
+                connection = connections[target] = Connection(target)
+            try:
+                status, length = await asyncio.wait_for(
+                    connection.get(), REQUEST_TIMEOUT
+                )
+            except (OSError, asyncio.TimeoutError, ValueError,
+                    IndexError, asyncio.IncompleteReadError) as e:
+                # The connection is in an unknown state so start afresh
+                connection.close()
+                error = type(e).__name__
+                target.errors[error] = target.errors.get(error, 0) + 1
+                continue
+            target.latencies.append(time.monotonic() - due)
+            target.statuses[status] = target.statuses.get(status, 0) + 1
+            target.bytes += length
+    finally:
+        for connection in connections.values():
+            connection.close()
+
+
+async def run(targets, concurrency, duration, rate=None):
+    """Loads targets for duration seconds, returning how long it took"""
+    start = time.monotonic()
+    schedule = Schedule(start, rate)
+    # Every worker takes the next target in turn from a shared cycle
+    order = itertools.cycle(targets)
+    await asyncio.gather(*(
+        worker(order, schedule, start + duration)
+        for _ in range(concurrency)
+    ))
+    return time.monotonic() - start
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of a sorted list"""
+    if not ordered:
+        return math.nan
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def histogram(latencies):
+    """Returns [(upper bound, count)] for buckets doubling from
+    BUCKET_START, with anything slower counted in the last one
+    """
+    counts = [0] * N_BUCKETS
+    for latency in latencies:
+        bucket = 0
+        if latency > BUCKET_START:
+            bucket = min(
+                N_BUCKETS - 1, math.ceil(math.log2(latency / BUCKET_START))
+            )
+        counts[bucket] += 1
+    return [
+        (BUCKET_START * 2 ** bucket, count)
+        for bucket, count in enumerate(counts)
+    ]
+
+
+def format_ms(seconds):
+    return f"{seconds * 1000:9.2f}ms"
+
+
+def report(targets, elapsed):
+    total = sum(len(target.latencies) for target in targets)
+    failed = sum(sum(target.errors.values()) for target in targets)
+    print(
+        f"\n{total} responses and {failed} errors in {elapsed:.2f}s, "
+        f"{total / elapsed:.1f} requests/s"
+    )
+    for target in targets:
+        ordered = sorted(target.latencies)
+        n_errors = sum(target.errors.values())
+        print(f"\n{target.url}")
+        print(
+            f"  {len(ordered)} responses, {n_errors} errors, "
+            f"{len(ordered) / elapsed:.1f} requests/s, "
+            f"{target.bytes / elapsed / 1024:.1f} KiB/s"
+        )
+        statuses = ", ".join(
+            f"{status}: {count}"
+            for status, count in sorted(target.statuses.items())
+        )
+        errors = ", ".join(
+            f"{error}: {count}"
+            for error, count in sorted(target.errors.items())
+        )
+        if statuses:
+            print(f"  status  {statuses}")
+        if errors:
+            print(f"  errors  {errors}")
+        if not ordered:
+            continue
+        print("  " + "  ".join(
+            f"p{p} {format_ms(percentile(ordered, p)).strip()}"
+            for p in PERCENTILES
+        ) + f"  max {format_ms(ordered[-1]).strip()}")
+        buckets = histogram(ordered)
+        used = [i for i, (_, count) in enumerate(buckets) if count]
+        most = max(count for _, count in buckets)
+        for bound, count in buckets[used[0]:used[-1] + 1]:
+            bar = "#" * math.ceil(count / most * BAR_WIDTH) if count else ""
+            print(f"  <{format_ms(bound)} {count:8} {bar}")
+
+
+async def handle(reader, writer, root):
+    """Serves files below root to one client until it disconnects"""
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            headers = await read_headers(reader)
+            try:
+                method, target, version = (
+                    request_line.decode("latin-1").split()
+                )
+            except ValueError:
+                return
+            if "content-length" in headers:
+                await reader.readexactly(int(headers["content-length"]))
+            status, body, content_type = respond(method, target, root)
+            keep_alive = (
+                headers.get("connection", "").lower() != "close"
+                and version == "HTTP/1.1"
+            )
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}"
+                f"\r\n\r\n".encode()
+            )
+            if method != "HEAD":
+                writer.write(body)
+            await writer.drain()
+            if not keep_alive:
+                return
+    except (ConnectionError, asyncio.IncompleteReadError):
+        return
+    finally:
+        writer.close()
+
+
+def respond(method, target, root):
+    """Returns (status, body, content type) for a request"""
+    if method not in ("GET", "HEAD"):
+        return "405 Method Not Allowed", b"", "text/plain"
+    path = target.split("?", 1)[0]
+    if path.endswith("/"):
+        path += "index.html"
+    file_path = os.path.realpath(os.path.join(root, path.lstrip("/")))
+    if not file_path.startswith(os.path.realpath(root) + os.sep):
+        return "404 Not Found", b"", "text/plain"
+    try:
+        with open(file_path, "rb") as infile:
+            body = infile.read()
+    except (FileNotFoundError, IsADirectoryError):
+        return "404 Not Found", b"Not found\n", "text/plain"
+    content_type = CONTENT_TYPES.get(
+        os.path.splitext(file_path)[1], "application/octet-stream"
+    )
+    return "200 OK", body, content_type
+
+
+async def start_server(root, port, host="127.0.0.1"):
+    return await asyncio.start_server(
+        lambda reader, writer: handle(reader, writer, root), host, port
+    )
+
+
+async def serve(root, port, host):
+    server = await start_server(root, port, host)
+    print(f"Serving {os.path.realpath(root)} on http://{host}:{port}/")
+    async with server:
+        await server.serve_forever()
+
+
+async def load_test(urls, concurrency, duration, rate, local, root):
+    server = None
+    if local:
+        server = await start_server(root, 0)
+        port = server.sockets[0].getsockname()[1]
+        urls = urls + [f"http://127.0.0.1:{port}/"]
+    targets = [Target(url) for url in urls]
+    print(
+        f"Loading {len(targets)} targets with {concurrency} connections "
+        f"for {duration:g}s"
+        + (f" at {rate:g} requests/s" if rate else "")
+    )
+    try:
+        elapsed = await run(targets, concurrency, duration, rate)
+    finally:
+        if server is not None:
+            server.close()
+            await server.wait_closed()
+    report(targets, elapsed)
+
+
+def usage():
+    print(
+        "usage: loadtest.py run [-c concurrency] [-r rate] [-d duration] "
+        "[-l] [URL...]\n"
+        "       loadtest.py serve [-p port] [-r root] [-b bind address]"
+    )
+    sys.exit(2)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in ("run", "serve"):
+        usage()
+    command = sys.argv[1]
+    if command == "serve":
+        opts = getopt.getopt(
+            sys.argv[2:], "p:r:b:", ["port=", "root=", "bind="]
+        )[0]
+        port = DEFAULT_PORT
+        root = DEFAULT_ROOT
+        host = "127.0.0.1"
+        for opt in opts:
+            if opt[0] == '-p' or opt[0] == '--port':
+                port = int(opt[1])
+            elif opt[0] == '-r' or opt[0] == '--root':
+                root = opt[1]
+            elif opt[0] == '-b' or opt[0] == '--bind':
+                host = opt[1]
+        try:
+            asyncio.run(serve(root, port, host))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    opts, urls = getopt.getopt(
+        sys.argv[2:], "c:r:d:l",
+        ["concurrency=", "rate=", "duration=", "local"]
+    )
+    concurrency = DEFAULT_CONCURRENCY
+    duration = DEFAULT_DURATION
+    rate = None
+    local = False
+    for opt in opts:
+        if opt[0] == '-c' or opt[0] == '--concurrency':
+            concurrency = int(opt[1])
+        elif opt[0] == '-r' or opt[0] == '--rate':
+            rate = float(opt[1])
+        elif opt[0] == '-d' or opt[0] == '--duration':
+            duration = float(opt[1])
+        elif opt[0] == '-l' or opt[0] == '--local':
+            local = True
+    if not urls and not local:
+        usage()
+    asyncio.run(
+        load_test(urls, concurrency, duration, rate, local, DEFAULT_ROOT)
+    )
+
+
+if __name__ == "__main__":
+    main()